@@ -2,10 +2,21 @@
 
 from __future__ import annotations
 
+import asyncio
+import atexit
+import concurrent.futures
 import logging
 import os
+import pathlib
+import re
+import threading
+import time
+from collections import deque
+from typing import Any
 from typing import Callable
+from typing import Optional
 from typing import NewType
+from typing import TypeVar
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
@@ -14,19 +25,36 @@ import dataclasses
 
 import bytewax.operators as op
 from bytewax.dataflow import Dataflow
+from bytewax.dataflow import operator
+from bytewax.operators import KeyedStream
+from bytewax.operators import UnaryLogic
 from bytewax.operators.window import EventClockConfig
 from bytewax.operators.window import TumblingWindow
 from bytewax.operators.window import WindowMetadata
 
 import openai
 
+from utils.connectors.slack import OverflowPolicy
 from utils.connectors.slack import SlackMessage
 from utils.connectors.slack import SlackSource
 from utils.connectors.slack import SlackSink
+from utils.connectors.slack import SlackUpdates
+from utils.cache import SemanticCache
+from utils.connectors.documents import DirectorySource
+from utils.connectors.documents import DocumentDatabaseSink
 from utils.qdrant import DocumentDatabase
+from utils.qdrant import connect_document_database
 
 log = logging.getLogger(__name__)
 
+# The tag Slack uses when the bot is @mentioned
+BOT_MENTION = "<@U06JJAU0M9B>"
+
+S = TypeVar("S")  # State
+V = TypeVar("V")  # Value
+W = TypeVar("W")  # Output value
+U = TypeVar("U")  # Update
+
 Summary = NewType("Summary", str)
 Context = NewType("Context", list[str])
 
@@ -57,16 +85,35 @@ def get_message_channel(msg: SlackMessage) -> str:
     return msg.channel
 
 
-def channel_is(channel: str) -> Callable[[tuple[str, SlackMessage]], bool]:
-    """Predicate function to check if the message was posted on the given channel."""
+def channel_in(
+    channels: Optional[set[str]],
+) -> Callable[[tuple[str, SlackMessage]], bool]:
+    """Predicate function to check if the message was posted on one of the channels.
+
+    With `channels` set to `None`, messages of all channels are accepted.
+    """
 
     def _func(item: tuple[str, SlackMessage]) -> bool:
         _, msg = item
-        return msg.channel == channel
+        return channels is None or msg.channel in channels
 
     return _func
 
 
+def _get_channels() -> Optional[set[str]]:
+    """Get the channels to listen to, `None` for all channels.
+
+    SLACK_CHANNEL_IDS is a comma separated list of channel ids, or "*" for all
+    channels. Without it, only SLACK_CHANNEL_ID is listened to.
+    """
+    channel_ids = os.environ.get("SLACK_CHANNEL_IDS")
+    if channel_ids is None:
+        return {os.environ["SLACK_CHANNEL_ID"]}
+    if channel_ids.strip() == "*":
+        return None
+    return {channel.strip() for channel in channel_ids.split(",") if channel.strip()}
+
+
 def is_mention(item: tuple[str, SlackMessage]) -> bool:
     """Predicate function to check if the message contains a mention of the bot.
 
@@ -74,7 +121,7 @@ def is_mention(item: tuple[str, SlackMessage]) -> bool:
     not be able to easily branch on it.
     """
     _, msg = item
-    return "<@U06JJAU0M9B>" in msg.text  # check for @mention
+    return BOT_MENTION in msg.text  # check for @mention
 
 
 def _create_llm_client() -> openai.AzureOpenAI:
@@ -87,12 +134,59 @@ def _create_llm_client() -> openai.AzureOpenAI:
     )
 
 
+def _create_async_llm_client() -> openai.AsyncAzureOpenAI:
+    return openai.AsyncAzureOpenAI(
+        api_version="2023-09-01-preview",
+        azure_endpoint=os.environ["LLM_ENDPOINT"],
+        api_key=os.environ["OPENAI_API_KEY"],
+        azure_deployment=os.environ["LLM_DEPLOYMENT"],
+        default_headers={"Ocp-Apim-Subscription-Key": os.environ["YOKOTAI_APIKEY"]},
+    )
+
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of LLM tokens in a text, without calling the LLM.
+
+    Counts words and punctuation marks, which is close enough to decide when a
+    summary is due.
+    """
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+@dataclasses.dataclass
+class SummaryState:
+    """The summary of a channel, and the messages not summarized yet."""
+
+    summary: Summary
+    pending: list[str] = dataclasses.field(default_factory=list)
+    pending_tokens: int = 0
+    oldest_pending: Optional[datetime] = None
+
+
 class Summarizer:
-    """A callable type which can be used in Bytewax `stateful_map`."""
+    """A callable type which can be used in Bytewax `stateful_map`.
 
-    def __init__(self):
+    New messages are collected in the state, and only summarized once they
+    reach `max_pending_tokens` or `max_pending_messages`, or the oldest of
+    them is `max_staleness` old when the next window arrives. A quiet channel
+    gets no new windows though, so `flush` summarizes whatever is pending
+    before the summary is used.
+    """
+
+    def __init__(
+        self,
+        max_pending_tokens: int = 500,
+        max_pending_messages: int = 20,
+        max_staleness: timedelta = timedelta(minutes=1),
+    ):
         """Initialize a summarizer with an LLM client and a prompt template."""
         self._llm_client = _create_llm_client()
+        self._max_pending_tokens = max_pending_tokens
+        self._max_pending_messages = max_pending_messages
+        self._max_staleness = max_staleness
         self._prompt = """Your task is to maintain a summary of the current ongoing discussion. You are given the current summary (which can be empty, if the discussion is just starting), and a set of new messages, the content of which you will add to the summary. Try to keep the summary under 200 words long.
 
 The messages will come in the format \"<username>: <Message>\". Respond with the new summary of the discussion.
@@ -103,25 +197,52 @@ Here is the current summary:
 """
 
     @classmethod
-    def create_initial_state(cls) -> Summary:
+    def create_initial_state(cls) -> SummaryState:
         """Get initial state for the stateful stream step."""
-        return Summary("No-one has said anything yet.")
+        return SummaryState(Summary("No-one has said anything yet."))
+
+    def _is_due(self, state: SummaryState, now: datetime) -> bool:
+        return (
+            state.pending_tokens >= self._max_pending_tokens
+            or len(state.pending) >= self._max_pending_messages
+            or now - state.oldest_pending >= self._max_staleness
+        )
 
     def __call__(
-        self, previous_state: str, item: tuple[WindowMetadata, list[SlackMessage]]
-    ) -> tuple[Summary, Summary]:
+        self, state: SummaryState, item: tuple[WindowMetadata, list[SlackMessage]]
+    ) -> SummaryState:
         """This is called whenewer a new window of messages arrive.
 
         It gets the previous state as the first argument, and returns the new
-        state and an object to be passed downstream.
+        state, with the summary updated if it was due.
         """
         _, messages = item  # we don't need the window metadata here
+        if not messages:
+            return state
 
-        system_prompt = self._prompt.format(summary=previous_state)
+        for message in messages:
+            line = f" - {message.user}: {message.text}"
+            state.pending.append(line)
+            state.pending_tokens += estimate_tokens(line)
 
-        user_prompt = "\n".join(
-            [f" - {message.user}: {message.text}" for message in messages]
-        )
+        now = max(message.timestamp for message in messages)
+        if state.oldest_pending is None:
+            state.oldest_pending = min(message.timestamp for message in messages)
+
+        if not self._is_due(state, now):
+            return state
+        return self._summarize(state)
+
+    def flush(self, state: SummaryState) -> SummaryState:
+        """Summarize the pending messages, if there are any."""
+        if not state.pending:
+            return state
+        return self._summarize(state)
+
+    def _summarize(self, state: SummaryState) -> SummaryState:
+        system_prompt = self._prompt.format(summary=state.summary)
+
+        user_prompt = "\n".join(state.pending)
         completion = self._llm_client.chat.completions.create(
             model=os.environ["LLM_DEPLOYMENT"],
             messages=[
@@ -132,56 +253,116 @@ Here is the current summary:
         )
 
         summary = Summary(completion.choices[0].message.content)
-
-        new_state = summary
-        return new_state, summary
+        return SummaryState(summary)
 
 
 def context_retriever(
     document_storage: DocumentDatabase,
-) -> Callable[[tuple[str, SlackMessage]], tuple[str, AugmentedMessage]]:
-    """Get a function for retrieving context from the given document database."""
+) -> Callable[[list[tuple[str, SlackMessage]]], list[tuple[str, AugmentedMessage]]]:
+    """Get a function for retrieving context from the given document database.
+
+    The function handles a whole batch of questions with a single search.
+    """
 
     def _func(
-        item: tuple[str, SlackMessage],
-    ) -> tuple[str, AugmentedMessage]:
-        key, msg = item
-        results = document_storage.search(msg.text, limit=10)
-        return key, AugmentedMessage(
-            message=msg, related_summary=Summary(""), related_context=Context(results)
+        items: list[tuple[str, SlackMessage]],
+    ) -> list[tuple[str, AugmentedMessage]]:
+        results = document_storage.search_batch(
+            [msg.text for _, msg in items], limit=10
         )
+        return [
+            (
+                key,
+                AugmentedMessage(
+                    message=msg,
+                    related_summary=Summary(""),
+                    related_context=Context(context),
+                ),
+            )
+            for (key, msg), context in zip(items, results)
+        ]
 
     return _func
 
 
-def join_summary_to_question(
-    previous_question_id: str | None, item: tuple[AugmentedMessage, Summary]
-) -> tuple[str, tuple[AugmentedMessage, bool]]:
-    """Join the summary data with the question message."""
-    message, summary = item
+def add_summary(message: AugmentedMessage, state: SummaryState) -> AugmentedMessage:
+    """Add the summary of the discussion to the question message."""
+    message.related_summary = state.summary
+    return message
+
+
+@operator
+def enrich_with_latest(
+    step_id: str,
+    up: KeyedStream[V],
+    latest: KeyedStream[U],
+    builder: Callable[[], S],
+    enricher: Callable[[V, S], W],
+    folder: Optional[Callable[[S, U], S]] = None,
+    refresher: Optional[Callable[[S], S]] = None,
+) -> KeyedStream[W]:
+    """Enrich every item with the latest value seen on another stream.
+
+    Items of `latest` only update the stored value of their key and are not
+    emitted. Every item of `up` is emitted exactly once, enriched with the
+    stored value of its key, or with `builder()` if there is none yet.
+
+    By default the state of a key is just its latest value. With a `folder`,
+    each value is instead folded into the state with `folder(state, value)`.
+    With a `refresher`, the state is replaced by `refresher(state)` before an
+    item is enriched with it, to bring it up to date first.
+    """
+    items = op.map_value("tag_items", up, lambda v: (True, v))
+    values = op.map_value("tag_latest", latest, lambda u: (False, u))
+    merged = op.merge("merge", items, values)
 
-    if message is None:
-        return None, (None, False)
+    def _lookup(state: S, item: tuple[bool, Any]) -> tuple[S, Optional[W]]:
+        is_item, value = item
+        if is_item:
+            if refresher is not None:
+                state = refresher(state)
+            return state, enricher(value, state)
+        if folder is not None:
+            return folder(state, value), None
+        return value, None
 
-    if summary is None:
-        summary = Summarizer.create_initial_state()
+    enriched = op.stateful_map("lookup", merged, builder, _lookup)
+    return op.filter_value("filter_updates", enriched, lambda w: w is not None)
 
-    message.related_summary = summary
-    return message.message.id, (message, message.message.id != previous_question_id)
 
+class Generator:
+    """Generative AI based on the question and its context.
 
-def has_unique_flag_set(
-    item: tuple[str, tuple[AugmentedMessage, bool]],
-) -> bool:
-    _, (_, is_unique) = item
-    return is_unique
+    Questions are submitted with `submit`, which returns right away with a
+    future of the response. The LLM completions run on a background event loop,
+    up to `max_concurrency` of them at once, so the worker keeps processing
+    other messages (such as summarizing) while they are in flight. See
+    `generate_responses` for the dataflow step built on it.
 
+    With a `semantic_cache`, questions similar to one recently answered with the
+    same summary and context are answered from the cache, without calling the LLM.
 
-class Generator:
-    """Generative AI based on the question and its context."""
+    With `updates`, the completion is streamed and the response generated so far
+    is sent to Slack at most every `update_interval` seconds, so users can start
+    reading before the whole response is ready.
+    """
 
-    def __init__(self):
-        self._llm_client = _create_llm_client()
+    def __init__(
+        self,
+        semantic_cache: Optional[SemanticCache] = None,
+        max_concurrency: int = 8,
+        updates: Optional[SlackUpdates] = None,
+        update_interval: float = 1.0,
+    ):
+        self._semantic_cache = semantic_cache
+        self._max_concurrency = max_concurrency
+        self._updates = updates
+        self._update_interval = update_interval
+        # Workers of a process share this instance, and with it the event loop
+        # thread, the async client bound to the loop and the concurrency limit.
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
         self._prompt = """Your task is to assist the people in the discussion by responding to their messages.
 
 * As additional context, you are given a summary of what the discussion has been about, and some related documentation.
@@ -204,59 +385,241 @@ Here is relevant information from provided documents:
 * The following message will be the question the participants want you to answer.
 """
 
-    def __call__(self, message: AugmentedMessage) -> SlackMessage:
+    def submit(
+        self, message: AugmentedMessage
+    ) -> concurrent.futures.Future[SlackMessage]:
+        """Start generating the response to a question, without waiting for it."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._llm_client = _create_async_llm_client()
+                self._semaphore = asyncio.Semaphore(self._max_concurrency)
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="generator", daemon=True
+                )
+                self._thread.start()
+            loop = self._loop
+
+        return asyncio.run_coroutine_threadsafe(self._generate(message), loop)
+
+    def close(self) -> None:
+        """Stop the event loop, cancelling the completions still in flight."""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+
+        def _stop() -> None:
+            for task in asyncio.all_tasks(loop):
+                task.cancel()
+            loop.stop()
+
+        loop.call_soon_threadsafe(_stop)
+        thread.join()
+        loop.close()
+
+    async def _generate(self, message: AugmentedMessage) -> SlackMessage:
+        user_prompt = message.message.text
+        cache_context = (message.related_summary, tuple(message.related_context))
+
+        start = time.perf_counter()
+        response = None
+        if self._semantic_cache is not None:
+            response = self._semantic_cache.get(user_prompt, cache_context)
+
+        if response is not None:
+            log.debug(
+                "Answered from cache in %.1f ms, %s",
+                (time.perf_counter() - start) * 1000,
+                self._semantic_cache.stats(),
+            )
+        else:
+            async with self._semaphore:
+                response = await self._complete(message)
+            log.debug("LLM completion took %.2f s", time.perf_counter() - start)
+            if self._semantic_cache is not None:
+                self._semantic_cache.put(user_prompt, cache_context, response)
 
+        return SlackMessage(
+            user="Bytewax",
+            id=message.message.id,
+            channel=message.message.channel,
+            text=response,
+            timestamp=datetime.now(timezone.utc),
+        )
+
+    async def _complete(self, message: AugmentedMessage) -> str:
         system_prompt = self._prompt.format(
             summary=message.related_summary, documents="\n".join([f" * {s}" for s in message.related_context])
         )
         user_prompt = message.message.text
 
-        completion = self._llm_client.chat.completions.create(
+        completion = await self._llm_client.chat.completions.create(
             model=os.environ["LLM_DEPLOYMENT"],
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt},
             ],
             max_tokens=1024,
+            stream=self._updates is not None,
         )
 
-        response = completion.choices[0].message.content or ""
+        if self._updates is None:
+            return completion.choices[0].message.content or ""
+
+        response = ""
+        last_update = time.monotonic()
+        async for chunk in completion:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+
+            response += chunk.choices[0].delta.content
+            if time.monotonic() - last_update >= self._update_interval:
+                last_update = time.monotonic()
+                self._updates.send(
+                    SlackMessage(
+                        user="Bytewax",
+                        id=message.message.id,
+                        channel=message.message.channel,
+                        text=f"{response} …",
+                        timestamp=datetime.now(timezone.utc),
+                    )
+                )
+
+        return response
+
+
+class _InFlightResponses(UnaryLogic[AugmentedMessage, SlackMessage, None]):
+    """The responses to the questions of one channel, while they are generated.
+
+    Responses are emitted in the order their questions were asked, as soon as
+    they and the responses before them are ready. Until then, the operator is
+    woken every `poll_interval` to look for finished ones.
+    """
 
-        return SlackMessage(
-            user="Bytewax",
-            id=message.message.id,
-            channel=message.message.channel,
-            text=response,
-            timestamp=datetime.now(timezone.utc),
-        )
+    def __init__(self, generator: Generator, poll_interval: timedelta):
+        self._generator = generator
+        self._poll_interval = poll_interval
+        self._pending: deque[concurrent.futures.Future[SlackMessage]] = deque()
+
+    def _finished(self) -> tuple[list[SlackMessage], bool]:
+        responses = []
+        while self._pending and self._pending[0].done():
+            responses.append(self._pending.popleft().result())
+        return responses, UnaryLogic.RETAIN if self._pending else UnaryLogic.DISCARD
+
+    def on_item(
+        self, now: datetime, value: AugmentedMessage
+    ) -> tuple[list[SlackMessage], bool]:
+        self._pending.append(self._generator.submit(value))
+        return self._finished()
+
+    def on_notify(self, sched: datetime) -> tuple[list[SlackMessage], bool]:
+        return self._finished()
+
+    def on_eof(self) -> tuple[list[SlackMessage], bool]:
+        # No more questions are coming, so wait for the rest of the responses
+        responses = [future.result() for future in self._pending]
+        self._pending.clear()
+        return responses, UnaryLogic.DISCARD
+
+    def notify_at(self) -> Optional[datetime]:
+        if not self._pending:
+            return None
+        return datetime.now(timezone.utc) + self._poll_interval
+
+    def snapshot(self) -> None:
+        # Completions in flight can't be resumed, so there is nothing to recover
+        return None
+
+
+@operator
+def generate_responses(
+    step_id: str,
+    up: KeyedStream[AugmentedMessage],
+    generator: Generator,
+    poll_interval: timedelta = timedelta(milliseconds=50),
+) -> KeyedStream[SlackMessage]:
+    """Generate the responses to questions, keeping many of them in flight.
+
+    The worker doesn't wait for the completions, and a slow one only holds back
+    the later responses of its own key.
+    """
+    return op.unary(
+        "unary",
+        up,
+        lambda now, resume_state: _InFlightResponses(generator, poll_interval),
+    )
 
 
-def _build_dataflow() -> Dataflow:
-    # Initialize a vector database in-memory
-    document_storage = DocumentDatabase(model="BAAI/bge-small-en-v1.5")
+def _create_document_storage() -> DocumentDatabase:
+    # With many worker processes, share a single database served by
+    # `python -m utils.qdrant data/dataset.txt` instead of loading the documents
+    # and the embedding model in every process.
+    address = os.environ.get("DOCUMENT_DB_ADDRESS")
+    if address:
+        # Fails without DOCUMENT_DB_AUTHKEY, as the database is never shared openly
+        log.info("Connecting to document database at %s", address)
+        return connect_document_database(
+            address, os.environ.get("DOCUMENT_DB_AUTHKEY", "").encode("utf-8")
+        )
+
+    # Initialize a vector database, in-memory unless DOCUMENT_DB_PATH is set. With
+    # DOCUMENT_DB_HYBRID set, exact terms are also searched with a lexical index.
+    document_storage = DocumentDatabase(
+        model="BAAI/bge-small-en-v1.5",
+        path=os.environ.get("DOCUMENT_DB_PATH") or None,
+        hybrid=bool(os.environ.get("DOCUMENT_DB_HYBRID")),
+    )
 
     # Load the preloaded documents
     # This step will calculate the embeddings for all of the chapters in the
-    # document.
+    # document. With a persistent database, only chapters that changed since the
+    # previous run are embedded, and those removed from the document are deleted.
     log.info("Loading documents to document database...")
-    document_storage.upload_text_chapterwise("data/dataset.txt")
+    document_path = "data/dataset.txt"
+    document_storage.upsert_document(
+        document_path, pathlib.Path(document_path).read_text()
+    )
     log.info("Document loading finished")
+    return document_storage
+
+
+def _build_dataflow() -> Dataflow:
+    document_storage = _create_document_storage()
 
     # Create a bytewax stream object.
     flow = Dataflow("supercharged-slackbot")
 
-    # Data will be flowing in from the Slack stream.
-    stream = op.input("input", flow, SlackSource(url=os.environ["SLACK_PROXY_URL"]))
+    # Data will be flowing in from the Slack stream. The proxy only sends us the
+    # messages of the channels we are listening to, and sends all messages of a
+    # channel to the same worker. Received messages wait in a bounded queue; when
+    # the dataflow falls behind, other messages are dropped before mentions.
+    channels = _get_channels()
+    stream = op.input(
+        "input",
+        flow,
+        SlackSource(
+            url=os.environ["SLACK_PROXY_URL"],
+            routing="channel",
+            channels=channels,
+            mention=BOT_MENTION,
+            queue_size=int(os.environ.get("SLACK_SOURCE_QUEUE_SIZE", "1000")),
+            overflow=OverflowPolicy(
+                os.environ.get("SLACK_SOURCE_OVERFLOW_POLICY", "drop-non-mentions")
+            ),
+        ),
+    )
 
-    # Key the stream elements based on the channel id. In here we are not processing
-    # any channels separately, but this approach very much allows it. The windowing
-    # step requires a keyed stream, so that's why we are adding it here.
+    # Key the stream elements based on the channel id. Every channel gets its own
+    # window, summary and join state, and Bytewax spreads the channels over the
+    # workers by their key.
     keyed_stream = op.key_on("key_on_channel", stream, get_message_channel)
 
-    # Filter the messages based on which Slack channel they were posted on.
-    filtered_stream = op.filter(
-        "filter_channel", keyed_stream, channel_is(os.environ["SLACK_CHANNEL_ID"])
-    )
+    # Filter the messages based on which Slack channel they were posted on. This is
+    # a no-op with a subscribing proxy, but keeps older proxies working.
+    filtered_stream = op.filter("filter_channel", keyed_stream, channel_in(channels))
 
     # Branch the stream into two: one for bot mentions, one for the rest
     b_out = op.branch("is_mention", filtered_stream, is_mention)
@@ -278,45 +641,91 @@ def _build_dataflow() -> Dataflow:
     )
     windowed_messages = op.window.collect_window("window", messages, clock, windower)
 
-    # Create a stateful step which keeps track of the current discussion summary
-    summarizer = Summarizer()
-    summary_stream = op.stateful_map(
-        "summarize", windowed_messages, summarizer.create_initial_state, summarizer
+    # Keep track of the current discussion summary of each channel. New messages
+    # are only summarized once enough of them have piled up, the oldest of them
+    # has waited for SUMMARY_MAX_STALENESS seconds, or a question needs the
+    # summary. Messages of a window that hasn't closed yet are not included.
+    summarizer = Summarizer(
+        max_pending_tokens=int(os.environ.get("SUMMARY_MAX_TOKENS", "500")),
+        max_pending_messages=int(os.environ.get("SUMMARY_MAX_MESSAGES", "20")),
+        max_staleness=timedelta(
+            seconds=float(os.environ.get("SUMMARY_MAX_STALENESS", "60"))
+        ),
     )
 
-    # Augment the message with the context from document database
-    mentions_with_context = op.map(
+    # Augment the message with the context from document database. Questions
+    # arriving together are looked up with a single batched search.
+    mentions_with_context = op.flat_map_batch(
         "augment_with_context", mentions, context_retriever(document_storage)
     )
 
-    # Join the two streams back together
-    joined = op.join(
-        "join_streams",
+    # Add the latest summary of the channel to each question, summarizing the
+    # pending messages first. Windows of messages only update the summary state,
+    # so every question is emitted exactly once.
+    questions_with_summary = enrich_with_latest(
+        "augment_with_summary",
         mentions_with_context,
-        summary_stream,
-        running=True,
+        windowed_messages,
+        summarizer.create_initial_state,
+        add_summary,
+        folder=summarizer,
+        refresher=summarizer.flush,
     )
 
-    # Our running join will emit a new item each time either of the upstreams changes.
-    # In our case we are only caring about the change in the mentions-stream.
-    # Thus, we only let each mention/question go through this step once by first
-    # flagging them with a `stateful_map` and filtering the flagged items with `filter`.
-    flagged = op.stateful_map(
-        "augment_with_summary", joined, lambda: None, join_summary_to_question
-    )
-
-    unique_questions = op.filter("filter_flagged", flagged, has_unique_flag_set)
-
-    questions = op.map("remove_flag_and_key", unique_questions, lambda x: x[1][0])
-
     # NOTE: Here one could do an additional lookup to document database based on
     #       the current summary, and extend the context of the message.
 
-    # Finally, generate a response
-    responses = op.map("generate", questions, Generator())
-
-    # Finally, finally, send the reply back to the source of the question!
-    op.output("output", responses, SlackSink(url=os.environ["SLACK_PROXY_URL"]))
+    # Finally, generate a response. Set ANSWER_CACHE_THRESHOLD to reuse the
+    # answers to recently asked, similar enough questions.
+    semantic_cache = None
+    if os.environ.get("ANSWER_CACHE_THRESHOLD"):
+        semantic_cache = SemanticCache(
+            document_storage.embed_queries,
+            threshold=float(os.environ["ANSWER_CACHE_THRESHOLD"]),
+            max_age=float(os.environ.get("ANSWER_CACHE_MAX_AGE", "600")),
+        )
+    # Questions are answered concurrently, with up to LLM_MAX_CONCURRENCY
+    # completions in flight per process. The worker carries on while they are
+    # generated, and the responses of a channel are sent in the order asked.
+    # With STREAM_RESPONSES set, partial responses show up in Slack while they
+    # are being generated, if the proxy supports them.
+    updates = None
+    if os.environ.get("STREAM_RESPONSES"):
+        updates = SlackUpdates(url=os.environ["SLACK_PROXY_URL"])
+        atexit.register(updates.close)
+    generator = Generator(
+        semantic_cache,
+        max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", "8")),
+        updates=updates,
+    )
+    keyed_responses = generate_responses(
+        "generate", questions_with_summary, generator
+    )
+    responses = op.map("remove_key", keyed_responses, lambda x: x[1])
+
+    # Finally, finally, send the reply back to the source of the question! When
+    # the proxy can't keep up, the bounded reply queue stalls the dataflow.
+    sink = SlackSink(
+        url=os.environ["SLACK_PROXY_URL"],
+        queue_size=int(os.environ.get("SLACK_SINK_QUEUE_SIZE", "1000")),
+        overflow=OverflowPolicy(os.environ.get("SLACK_SINK_OVERFLOW_POLICY", "block")),
+    )
+    op.output("output", responses, sink)
+
+    # Keep the document database up to date with the documents dropped into
+    # DOCUMENTS_DIR, so new knowledge is available without restarting. Every
+    # process uploads all documents to its own database, unless they share one
+    # at DOCUMENT_DB_ADDRESS, which then gets each document from one worker.
+    documents_dir = os.environ.get("DOCUMENTS_DIR")
+    if documents_dir:
+        documents = op.input(
+            "documents",
+            flow,
+            DirectorySource(
+                documents_dir, shared=bool(os.environ.get("DOCUMENT_DB_ADDRESS"))
+            ),
+        )
+        op.output("upload_documents", documents, DocumentDatabaseSink(document_storage))
 
     return flow
 
@@ -0,0 +1,126 @@
+"""Fixtures shared by the tests, which run offline with stand-ins for services."""
+
+import hashlib
+import json
+import threading
+from typing import Iterable
+from typing import Iterator
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+import numpy as np
+import pytest
+import websockets.sync.server
+from qdrant_client import QdrantClient
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.server import ServerConnection
+
+from utils.qdrant import DocumentDatabase
+
+MODEL = "BAAI/bge-small-en-v1.5"
+
+
+class StubEmbedding:
+    """Embeds texts as hashed bags of words, in place of the fastembed model.
+
+    Texts sharing words get similar vectors, which is all the tests need, and
+    nothing has to be downloaded.
+    """
+
+    dimensions = 384
+
+    def __init__(self):
+        self.calls = 0
+        self.embedded: list[str] = []
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in text.lower().split():
+            word = word.strip(".,:;!?")
+            if word in ("query", "passage"):
+                continue
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.dimensions] += 1
+        return vector / (np.linalg.norm(vector) or 1)
+
+    def embed(
+        self, texts: Iterable[str], batch_size: int = 256, parallel=None
+    ) -> Iterator[np.ndarray]:
+        self.calls += 1
+        if isinstance(texts, str):
+            texts = [texts]
+        for text in texts:
+            self.embedded.append(text)
+            yield self._embed(text)
+
+    def passage_embed(self, texts: Iterable[str], **kwargs) -> Iterator[np.ndarray]:
+        return self.embed([f"passage: {text}" for text in texts], **kwargs)
+
+    def query_embed(self, query: str) -> Iterator[np.ndarray]:
+        return self.embed([f"query: {query}"])
+
+
+class StubProxy:
+    """A websocket server standing in for the Slack proxy.
+
+    Like the proxy, it greets the listeners that tell it which worker they are
+    and the connectors that ask for partial replies, unless `greet` is off.
+    Every connection is sent the frames in `frames`, and the frames received
+    from connections are recorded in `received`.
+    """
+
+    def __init__(self, port: int = 0):
+        self.greet = True
+        self.frames: list[str | bytes] = []
+        self.paths: list[str] = []
+        self.received: list[str | bytes] = []
+        self.connections: list[ServerConnection] = []
+        self._server = websockets.sync.server.serve(self._handle, "127.0.0.1", port)
+        host, port = self._server.socket.getsockname()
+        self.url = f"ws://{host}:{port}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def _handle(self, connection: ServerConnection) -> None:
+        self.connections.append(connection)
+        self.paths.append(connection.request.path)
+        query = parse_qs(urlsplit(connection.request.path).query)
+        try:
+            if self.greet and "worker_index" in query:
+                connection.send(json.dumps({"type": "subscribed"}))
+            if self.greet and "partial" in query:
+                connection.send(json.dumps({"type": "partial"}))
+            for frame in self.frames:
+                connection.send(frame)
+            for message in connection:
+                self.received.append(message)
+        except ConnectionClosed:
+            pass
+
+    def drop_connections(self) -> None:
+        """Close the open connections, as a restarting proxy would."""
+        for connection in self.connections:
+            connection.close()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self.drop_connections()
+
+
+@pytest.fixture
+def proxy() -> Iterator[StubProxy]:
+    stub = StubProxy()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def embedding_model(monkeypatch: pytest.MonkeyPatch) -> StubEmbedding:
+    model = StubEmbedding()
+    monkeypatch.setitem(QdrantClient.embedding_models, MODEL, model)
+    return model
+
+
+@pytest.fixture
+def document_database(embedding_model: StubEmbedding) -> DocumentDatabase:
+    return DocumentDatabase(model=MODEL)
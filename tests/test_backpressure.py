@@ -0,0 +1,73 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from utils.connectors.slack import OverflowPolicy
+from utils.connectors.slack.backpressure import BoundedQueue
+
+
+def _drain(q: BoundedQueue) -> list:
+    items = []
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            return items
+
+
+def test_drop_oldest():
+    q: BoundedQueue[int] = BoundedQueue(2, OverflowPolicy.DROP_OLDEST)
+    for i in range(5):
+        q.put(i)
+    assert _drain(q) == [3, 4]
+    assert q.dropped == 3
+
+
+def test_drop_non_mentions_keeps_mentions():
+    q: BoundedQueue[str] = BoundedQueue(
+        3, "drop-non-mentions", is_mention=lambda item: item.startswith("@")
+    )
+    for item in ["a", "@1", "b", "c", "@2", "@3", "@4"]:
+        q.put(item)
+    # "c" is dropped as the queue is full, then "a" and "b" make room for the
+    # mentions, and finally the oldest mention goes.
+    assert _drain(q) == ["@2", "@3", "@4"]
+    assert q.dropped == 4
+
+
+def test_drop_non_mentions_requires_a_predicate():
+    with pytest.raises(ValueError):
+        BoundedQueue(3, OverflowPolicy.DROP_NON_MENTIONS)
+
+
+def test_block_waits_for_room():
+    q: BoundedQueue[int] = BoundedQueue(1, OverflowPolicy.BLOCK)
+    q.put(1)
+    producer = threading.Thread(target=q.put, args=(2,))
+    producer.start()
+    time.sleep(0.05)
+    assert producer.is_alive()
+
+    assert q.get() == 1
+    producer.join(timeout=1)
+    assert not producer.is_alive()
+    assert q.get() == 2
+    assert q.dropped == 0
+
+
+def test_get_times_out():
+    q: BoundedQueue[int] = BoundedQueue(1)
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.01)
+    with pytest.raises(queue.Empty):
+        q.get_nowait()
+
+
+def test_unbounded():
+    q: BoundedQueue[int] = BoundedQueue(0, OverflowPolicy.DROP_OLDEST)
+    for i in range(100):
+        q.put(i)
+    assert q.qsize() == 100
+    assert q.dropped == 0
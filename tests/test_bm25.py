@@ -0,0 +1,52 @@
+from utils.bm25 import BM25Index
+from utils.bm25 import tokenize
+
+
+def test_tokenize_keeps_identifiers():
+    assert tokenize("Use op.stateful_map, not JOIN!") == [
+        "use",
+        "op",
+        "stateful_map",
+        "not",
+        "join",
+    ]
+
+
+def test_search_ranks_rare_terms_higher():
+    index = BM25Index()
+    index.add("a", "the window operator collects the stream")
+    index.add("b", "the stream is keyed, the stream is windowed")
+    index.add("c", "use stateful_map for running state")
+
+    results = index.search("stateful_map stream", limit=3)
+    assert [doc_id for doc_id, _, _ in results] == ["c", "b", "a"]
+    assert results[0][2] == "use stateful_map for running state"
+    assert results[0][1] > results[1][1] > results[2][1] > 0
+
+
+def test_search_skips_documents_without_query_terms():
+    index = BM25Index()
+    index.add("a", "windows and streams")
+    assert index.search("nothing matches") == []
+    assert BM25Index().search("windows") == []
+
+
+def test_add_replaces_and_remove_deletes():
+    index = BM25Index()
+    index.add("a", "old text about joins")
+    index.add("a", "new text about windows")
+    assert len(index) == 1
+    assert index.search("joins") == []
+    assert [doc_id for doc_id, _, _ in index.search("windows")] == ["a"]
+
+    index.remove("a")
+    index.remove("missing")
+    assert len(index) == 0
+    assert index.search("windows") == []
+
+
+def test_limit():
+    index = BM25Index()
+    for i in range(20):
+        index.add(str(i), f"stream number {i}")
+    assert len(index.search("stream", limit=5)) == 5
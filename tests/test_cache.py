@@ -0,0 +1,73 @@
+import pytest
+
+from utils.cache import LRUCache
+from utils.cache import SemanticCache
+
+
+def _embed(texts: list[str]) -> list[list[float]]:
+    # Questions about the same topic word get the same direction
+    topics = ["windows", "joins", "state"]
+    return [[float(topic in text) for topic in topics] + [0.1] for text in texts]
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache: LRUCache[int] = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2}
+
+
+def test_lru_cache_expires_entries(monkeypatch: pytest.MonkeyPatch):
+    now = [100.0]
+    monkeypatch.setattr("utils.cache.time.monotonic", lambda: now[0])
+    cache: LRUCache[int] = LRUCache(maxsize=2, ttl=10)
+    cache.put("a", 1)
+    now[0] += 9
+    assert cache.get("a") == 1
+    now[0] += 2
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_lru_cache_of_size_zero_stores_nothing():
+    cache: LRUCache[int] = LRUCache(maxsize=0)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+
+
+def test_semantic_cache_answers_similar_questions():
+    cache = SemanticCache(_embed, threshold=0.95)
+    cache.put("how do windows work?", "context", "with a clock")
+
+    assert cache.get("explain windows please", "context") == "with a clock"
+    assert cache.get("how do joins work?", "context") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_semantic_cache_keeps_contexts_apart():
+    cache = SemanticCache(_embed, threshold=0.95)
+    cache.put("how do windows work?", ("summary 1", ("doc",)), "with a clock")
+    assert cache.get("how do windows work?", ("summary 2", ("doc",))) is None
+
+
+def test_semantic_cache_answers_expire(monkeypatch: pytest.MonkeyPatch):
+    now = [100.0]
+    monkeypatch.setattr("utils.cache.time.monotonic", lambda: now[0])
+    cache = SemanticCache(_embed, threshold=0.95, max_age=60)
+    cache.put("how do windows work?", "context", "with a clock")
+    now[0] += 61
+    assert cache.get("how do windows work?", "context") is None
+
+
+def test_semantic_cache_prefers_the_closest_answer():
+    cache = SemanticCache(_embed, threshold=0.5)
+    cache.put("windows and joins", "context", "both")
+    cache.put("windows", "context", "windows only")
+    assert cache.get("windows", "context") == "windows only"
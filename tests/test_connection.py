@@ -0,0 +1,83 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from conftest import StubProxy
+from utils.connectors.slack.connection import Backoff
+from utils.connectors.slack.connection import connect
+
+
+def _unused_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _RecordingBackoff(Backoff):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delays: list[float] = []
+
+    def next_delay(self) -> float:
+        delay = super().next_delay()
+        self.delays.append(delay)
+        return delay
+
+
+def test_backoff_doubles_up_to_the_maximum(monkeypatch: pytest.MonkeyPatch):
+    # Without the jitter, every delay is the upper bound
+    monkeypatch.setattr(
+        "utils.connectors.slack.connection.random.uniform", lambda low, high: high
+    )
+    backoff = Backoff(initial=0.5, maximum=3.0)
+    assert [backoff.next_delay() for _ in range(5)] == [0.5, 1.0, 2.0, 3.0, 3.0]
+    backoff.reset()
+    assert backoff.next_delay() == 0.5
+
+
+def test_backoff_jitters_below_the_bound():
+    backoff = Backoff(initial=1.0, maximum=1.0)
+    delays = [backoff.next_delay() for _ in range(100)]
+    assert all(0 <= delay <= 1.0 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_connect_retries_until_the_proxy_is_up():
+    port = _unused_port()
+    backoff = _RecordingBackoff(initial=0.05, maximum=0.1)
+
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(
+            connect(f"ws://127.0.0.1:{port}/source", backoff, threading.Event())
+        )
+    )
+    thread.start()
+    time.sleep(0.3)
+    proxy = StubProxy(port)
+    try:
+        thread.join(timeout=5)
+        (connection,) = result
+        assert connection is not None
+        assert len(backoff.delays) >= 3
+        assert all(delay <= 0.1 for delay in backoff.delays)
+        # Connecting starts the backoff over
+        assert backoff.next_delay() <= 0.05
+        connection.close()
+    finally:
+        proxy.close()
+
+
+def test_connect_gives_up_once_stopped():
+    stop = threading.Event()
+    stop.set()
+    backoff = Backoff()
+    assert connect(f"ws://127.0.0.1:{_unused_port()}", backoff, stop) is None
+
+    stop = threading.Event()
+    threading.Timer(0.2, stop.set).start()
+    start = time.monotonic()
+    assert connect(f"ws://127.0.0.1:{_unused_port()}", backoff, stop) is None
+    assert time.monotonic() - start < 1
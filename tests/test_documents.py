@@ -0,0 +1,117 @@
+import pathlib
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from utils.connectors.documents import DirectorySource
+from utils.connectors.documents import DocumentDatabaseSink
+from utils.qdrant import DocumentDatabase
+
+
+def _sync(
+    source: DirectorySource,
+    database: DocumentDatabase,
+    workers: range = range(1),
+    worker_count: int = 1,
+):
+    # Runs one scan of each of the `workers` of a process, as the dataflow would
+    now = datetime.now(timezone.utc)
+    sink = DocumentDatabaseSink(database)
+    found = []
+    for worker_index in workers:
+        partition = source.build(now, worker_index, worker_count)
+        batch = list(partition.next_batch(now))
+        sink.build(worker_index, worker_count).write_batch(batch)
+        found.extend(batch)
+    return found
+
+
+def _top(database: DocumentDatabase, query: str) -> str:
+    results = database.search(query, limit=1)
+    return results[0] if results else ""
+
+
+def test_dropped_files_become_searchable(
+    tmp_path: pathlib.Path, document_database: DocumentDatabase
+):
+    document_database.upsert_document("seed", "Unrelated notes about cats.")
+    source = DirectorySource(str(tmp_path), interval=timedelta(0))
+
+    (tmp_path / "flags.txt").write_text("The zebrafrobnicator flag enables turbo.")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "csv.txt").write_text("The quokkaparser reads CSV input.")
+    _sync(source, document_database)
+
+    assert "zebrafrobnicator" in _top(document_database, "zebrafrobnicator flag")
+    assert "quokkaparser" in _top(document_database, "quokkaparser csv")
+
+
+def test_changed_and_deleted_files_are_updated(
+    tmp_path: pathlib.Path, document_database: DocumentDatabase
+):
+    document_database.upsert_document("seed", "Unrelated notes about cats.")
+    source = DirectorySource(str(tmp_path), interval=timedelta(0))
+    path = tmp_path / "flags.txt"
+    path.write_text("The zebrafrobnicator flag enables turbo.")
+    _sync(source, document_database)
+
+    path.write_text("The wombatizer flag disables turbo.")
+    _sync(source, document_database)
+    assert "wombatizer" in _top(document_database, "wombatizer flag")
+    assert "zebrafrobnicator" not in _top(document_database, "zebrafrobnicator")
+
+    path.unlink()
+    _sync(source, document_database)
+    assert _top(document_database, "wombatizer flag") == "Unrelated notes about cats."
+
+
+def test_unchanged_files_are_not_emitted_again(
+    tmp_path: pathlib.Path, document_database: DocumentDatabase
+):
+    source = DirectorySource(str(tmp_path), interval=timedelta(0))
+    path = tmp_path / "flags.txt"
+    path.write_text("The zebrafrobnicator flag enables turbo.")
+    assert len(_sync(source, document_database)) == 1
+
+    path.write_text(path.read_text())
+    assert _sync(source, document_database) == []
+
+
+def test_workers_of_a_process_emit_each_file_once(
+    tmp_path: pathlib.Path, document_database: DocumentDatabase
+):
+    for i in range(10):
+        (tmp_path / f"{i}.txt").write_text(f"Document number {i}.")
+
+    # Without a shared database, every process needs all files
+    for _ in range(2):
+        source = DirectorySource(str(tmp_path), interval=timedelta(seconds=60))
+        found = _sync(source, document_database, range(4), 4)
+        assert sorted(document.source for document in found) == sorted(
+            f"{i}.txt" for i in range(10)
+        )
+
+
+def test_workers_split_files_of_a_shared_database(
+    tmp_path: pathlib.Path, document_database: DocumentDatabase
+):
+    for i in range(10):
+        (tmp_path / f"{i}.txt").write_text(f"Document number {i}.")
+
+    # Each of the two processes builds its own source, for its four workers
+    found = []
+    shares = []
+    for process in range(2):
+        source = DirectorySource(str(tmp_path), shared=True)
+        for worker_index in range(4 * process, 4 * process + 4):
+            workers = range(worker_index, worker_index + 1)
+            batch = _sync(source, document_database, workers, 8)
+            shares.append(len(batch))
+            found += batch
+
+    assert sorted(document.source for document in found) == sorted(
+        f"{i}.txt" for i in range(10)
+    )
+    # Paths differing in a digit are still spread over the workers
+    assert sum(share > 0 for share in shares) >= 4
+    assert max(shares) <= 3
@@ -0,0 +1,487 @@
+import asyncio
+import json
+import time
+import types
+from typing import Iterator
+
+import bytewax.operators as op
+import pytest
+from bytewax.dataflow import Dataflow
+from bytewax.inputs import DynamicSource
+from bytewax.inputs import StatelessSourcePartition
+from bytewax.outputs import DynamicSink
+from bytewax.outputs import StatelessSinkPartition
+from bytewax.testing import cluster_main
+from slack_sdk.errors import SlackApiError
+from starlette.datastructures import Address
+from starlette.testclient import TestClient
+
+from utils import proxy
+from utils import wire
+from utils.proxy import EncodedEvent
+from utils.proxy import ListenerQueue
+from utils.proxy import OutboundScheduler
+from utils.proxy import Subscription
+from utils.proxy import TokenBucket
+
+EVENTS = [{"channel": f"C{i % 12}", "ts": f"{i}.0", "text": "hi"} for i in range(240)]
+
+
+def _wait_until(predicate, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+class FakeSlackClient:
+    """Records the posted and updated messages, failing when told to."""
+
+    def __init__(self):
+        self.calls: list[tuple[str, str, str]] = []
+        self.failures: list[Exception] = []
+        self.delay = 0.0
+
+    async def _call(self, kind: str, channel: str, text: str) -> dict[str, str]:
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            raise self.failures.pop(0)
+        self.calls.append((kind, channel, text))
+        return {"ts": f"posted-{len(self.calls)}"}
+
+    async def chat_postMessage(self, channel, text, thread_ts, username):
+        return await self._call("post", channel, text)
+
+    async def chat_update(self, channel, ts, text):
+        return await self._call("update", channel, text)
+
+
+def _rate_limited(retry_after: str) -> SlackApiError:
+    response = types.SimpleNamespace(
+        status_code=429, headers={"Retry-After": retry_after}
+    )
+    return SlackApiError("ratelimited", response)
+
+
+def _run(scheduler: OutboundScheduler, client: FakeSlackClient, steps) -> None:
+    # Runs the scheduler while feeding it submissions, waiting in between
+    async def _main():
+        task = asyncio.ensure_future(scheduler.run(client))
+        for step in steps:
+            if isinstance(step, (int, float)):
+                await asyncio.sleep(step)
+            else:
+                step()
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(_main())
+
+
+def test_subscription_routes_each_channel_to_one_worker():
+    workers = [
+        Subscription.from_query_params(
+            {"worker_index": str(i), "worker_count": "3", "routing": "channel"}
+        )
+        for i in range(3)
+    ]
+    for channel in ["C1", "C2", "C3", "C4"]:
+        for ts in ["1.0", "2.0"]:
+            event = {"channel": channel, "ts": ts, "text": "hi"}
+            assert sum(worker.accepts(event) for worker in workers) == 1
+
+
+class _SubscribedPartition(StatelessSourcePartition):
+    # Emits the events the proxy would send to this worker, tagged with it
+    def __init__(self, subscription: Subscription):
+        self._index = subscription.worker_index
+        self._events = [event for event in EVENTS if subscription.accepts(event)]
+
+    def next_batch(self, sched):
+        if self._events is None:
+            raise StopIteration()
+        batch = [(self._index, event["channel"]) for event in self._events]
+        self._events = None
+        return batch
+
+
+class _SubscribedSource(DynamicSource):
+    def __init__(self, routing: str):
+        self._routing = routing
+
+    def build(self, now, worker_index, worker_count):
+        subscription = Subscription(worker_index, worker_count, self._routing)
+        return _SubscribedPartition(subscription)
+
+
+class _WorkerSink(DynamicSink):
+    # Records the worker each item was received on and the one it reached
+    def __init__(self):
+        self.items: list[tuple[int, int]] = []
+
+    def build(self, worker_index, worker_count):
+        sink = self
+
+        class _Partition(StatelessSinkPartition):
+            def write_batch(self, items):
+                sink.items.extend((received, worker_index) for _, received in items)
+
+        return _Partition()
+
+
+def _exchanged(routing: str, worker_count: int = 4) -> int:
+    # Runs events through a step keyed by channel, like the dataflow's, and
+    # counts the events bytewax had to move to another worker for it
+    flow = Dataflow("exchange")
+    events = op.input("inp", flow, _SubscribedSource(routing))
+    keyed = op.key_on("key_on_channel", events, lambda item: item[1])
+    counted = op.stateful_map(
+        "count", keyed, lambda: 0, lambda count, item: (count + 1, item[0])
+    )
+    sink = _WorkerSink()
+    op.output("out", counted, sink)
+    cluster_main(flow, [], 0, worker_count_per_proc=worker_count)
+
+    assert len(sink.items) == len(EVENTS)
+    return sum(received != reached for received, reached in sink.items)
+
+
+def test_channel_routing_avoids_the_exchange():
+    assert _exchanged("random") > len(EVENTS) // 2
+    assert _exchanged("channel") == 0
+    assert _exchanged("channel", worker_count=3) == 0
+
+
+@pytest.fixture
+def client() -> Iterator[TestClient]:
+    yield TestClient(proxy.fastapi_app)
+    # Let the handlers of closed sessions unregister their listeners
+    _wait_until(lambda: not proxy.SOURCE_QUEUES)
+
+
+def _distribute(session, *events: dict) -> None:
+    # Hands Slack events to the proxy on the event loop of the test client, all
+    # of them before a listener can take the first one
+    async def _main():
+        for event in events:
+            await proxy.distribute_message_to_listeners({"event": event}, None)
+
+    session.portal.call(_main)
+
+
+def test_source_handler_greets_listeners_that_say_which_worker_they_are(client):
+    with client.websocket_connect("/source?worker_index=1&worker_count=2") as session:
+        assert json.loads(session.receive_text()) == {"type": "subscribed"}
+
+
+def test_source_handler_sends_only_events_to_other_listeners(client):
+    # Listeners of older dataflows expect every frame to be an event
+    with client.websocket_connect("/source") as session:
+        _wait_until(lambda: proxy.SOURCE_QUEUES)
+        _distribute(session, EVENTS[0])
+        assert json.loads(session.receive_bytes())["channel"] == "C0"
+
+
+def test_listener_queue_drop_oldest():
+    async def _main():
+        q = ListenerQueue(2, "drop-oldest")
+        for item in [b"1", b"2", b"3"]:
+            await q.put(item)
+        return await q.get_batch(10), q.dropped
+
+    assert asyncio.run(_main()) == ([b"2", b"3"], 1)
+
+
+def test_listener_queue_drop_non_mentions():
+    async def _main():
+        q = ListenerQueue(2, "drop-non-mentions", mention="<@B>")
+        for item in [b"a", b"<@B> 1", b"b", b"<@B> 2", b"<@B> 3"]:
+            await q.put(item)
+        return await q.get_batch(10), q.dropped
+
+    assert asyncio.run(_main()) == ([b"<@B> 2", b"<@B> 3"], 3)
+
+
+def test_listener_queue_block_and_close():
+    async def _main():
+        q = ListenerQueue(1, "block")
+        await q.put(b"1")
+        blocked = asyncio.ensure_future(q.put(b"2"))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        assert await q.get_batch(1) == [b"1"]
+        await asyncio.wait_for(blocked, 1)
+        assert await q.get_batch(5) == [b"2"]
+
+        # Closing releases blocked producers without queueing their events
+        await q.put(b"3")
+        blocked = asyncio.ensure_future(q.put(b"4"))
+        await asyncio.sleep(0.01)
+        q.close()
+        await asyncio.wait_for(blocked, 1)
+        assert q.qsize() == 0
+
+    asyncio.run(_main())
+
+
+def test_listener_queue_rejects_bad_policies():
+    with pytest.raises(ValueError):
+        ListenerQueue(1, "drop-newest")
+    with pytest.raises(ValueError):
+        ListenerQueue(1, "drop-non-mentions")
+
+
+def test_source_handler_coalesces_pending_events(client):
+    with client.websocket_connect("/source?batch=2") as session:
+        _wait_until(lambda: proxy.SOURCE_QUEUES)
+        _distribute(session, *EVENTS[:3])
+        first = json.loads(session.receive_bytes())
+        second = json.loads(session.receive_bytes())
+    assert [event["ts"] for event in first] == ["0.0", "1.0"]
+    assert [event["ts"] for event in second] == ["2.0"]
+
+
+def test_source_handler_sends_single_events_unless_asked_to_coalesce(client):
+    with client.websocket_connect("/source") as session:
+        _wait_until(lambda: proxy.SOURCE_QUEUES)
+        _distribute(session, *EVENTS[:2])
+        frames = [json.loads(session.receive_bytes()) for _ in range(2)]
+    assert [event["ts"] for event in frames] == ["0.0", "1.0"]
+
+
+def test_source_handler_concatenates_pending_records(client):
+    with client.websocket_connect("/source?batch=10&format=records") as session:
+        _wait_until(lambda: proxy.SOURCE_QUEUES)
+        _distribute(session, *EVENTS[:3])
+        records = wire.decode_records(session.receive_bytes(), wire.SOURCE_FIELDS)
+        assert [record["ts"] for record in records] == ["0.0", "1.0", "2.0"]
+
+
+def test_source_handler_sends_events_as_soon_as_they_arrive(client):
+    with client.websocket_connect("/source") as session:
+        _wait_until(lambda: proxy.SOURCE_QUEUES)
+        for event in EVENTS[:5]:
+            start = time.monotonic()
+            _distribute(session, event)
+            assert json.loads(session.receive_bytes())["ts"] == event["ts"]
+            assert time.monotonic() - start < 0.1
+
+
+def test_token_bucket_pause_allows_one_message_then_the_rate():
+    bucket = TokenBucket(rate=1.0, burst=3)
+    bucket.pause(0.0)
+    now = bucket._paused_until + 0.001
+    assert bucket.delay(now) == 0
+    bucket.take(now)
+    assert bucket.delay(now) == pytest.approx(1.0, abs=0.01)
+
+
+def _submitter(scheduler: OutboundScheduler, *args, **kwargs):
+    return lambda: scheduler.submit(*args, **kwargs)
+
+
+def test_scheduler_merges_queued_replies_to_a_thread():
+    scheduler = OutboundScheduler(rate=1000, burst=5)
+    client = FakeSlackClient()
+    for text in ["first", "second", "third"]:
+        scheduler.submit("C1", "1", text)
+    scheduler.submit("C1", "2", "other thread")
+    _run(scheduler, client, [])
+    assert client.calls == [
+        ("post", "C1", "first\n\nsecond\n\nthird"),
+        ("post", "C1", "other thread"),
+    ]
+    assert scheduler.merged == 2
+
+
+def test_scheduler_sends_urgent_replies_first():
+    scheduler = OutboundScheduler(rate=1000, burst=1)
+    client = FakeSlackClient()
+    scheduler.submit("C1", "1", "busy")
+    scheduler.submit("C1", "2", "later", priority=1)
+    scheduler.submit("C1", "3", "urgent", priority=-1)
+    _run(scheduler, client, [])
+    assert [text for _, _, text in client.calls] == ["urgent", "busy", "later"]
+
+
+def test_scheduler_retries_after_rate_limit_and_errors():
+    scheduler = OutboundScheduler(rate=1000, burst=5)
+    client = FakeSlackClient()
+    client.failures = [_rate_limited("0.05"), ConnectionError("reset")]
+    _run(scheduler, client, [_submitter(scheduler, "C1", "1", "reply"), 0.2])
+    assert client.calls == [("post", "C1", "reply")]
+    assert scheduler.rate_limited == 1
+    assert scheduler.sent == 1
+    assert scheduler.failed == 0
+
+
+def test_scheduler_gives_up_after_max_attempts():
+    scheduler = OutboundScheduler(rate=1000, burst=5, max_attempts=2)
+    client = FakeSlackClient()
+    client.failures = [ConnectionError("reset")] * 3
+    _run(scheduler, client, [_submitter(scheduler, "C1", "1", "reply"), 0.05])
+    assert client.calls == []
+    assert scheduler.failed == 1
+
+
+def test_scheduler_keeps_its_sends_until_they_are_done():
+    scheduler = OutboundScheduler(rate=1000, burst=5)
+    client = FakeSlackClient()
+    client.delay = 0.02
+    in_flight = []
+    _run(
+        scheduler,
+        client,
+        [
+            _submitter(scheduler, "C1", "1", "reply"),
+            _submitter(scheduler, "C2", "1", "reply"),
+            0.01,
+            lambda: in_flight.append(len(scheduler._tasks)),
+        ],
+    )
+    assert in_flight == [2]
+    assert len(client.calls) == 2
+    assert not scheduler._tasks
+
+
+def _stream(scheduler: OutboundScheduler, text: str, partial: bool):
+    return _submitter(scheduler, "C1", "1", text, partial=partial)
+
+
+def test_scheduler_edits_partial_replies_in_place():
+    scheduler = OutboundScheduler(rate=1000, burst=5)
+    client = FakeSlackClient()
+    _run(
+        scheduler,
+        client,
+        [
+            _stream(scheduler, "Hel …", True),
+            0.01,
+            _stream(scheduler, "Hello wo …", True),
+            0.01,
+            _stream(scheduler, "Hello world", False),
+        ],
+    )
+    assert client.calls == [
+        ("post", "C1", "Hel …"),
+        ("update", "C1", "Hello wo …"),
+        ("update", "C1", "Hello world"),
+    ]
+
+
+def test_scheduler_drops_partial_replies_after_the_final_one():
+    scheduler = OutboundScheduler(rate=1000, burst=5)
+    client = FakeSlackClient()
+    _run(
+        scheduler,
+        client,
+        [
+            _stream(scheduler, "Hel …", True),
+            0.01,
+            _stream(scheduler, "Hello world", False),
+            0.01,
+            _stream(scheduler, "Hello wo …", True),
+        ],
+    )
+    assert client.calls == [
+        ("post", "C1", "Hel …"),
+        ("update", "C1", "Hello world"),
+    ]
+    assert scheduler.stale == 1
+
+
+def test_scheduler_final_reply_supersedes_queued_partials():
+    scheduler = OutboundScheduler(rate=1000, burst=1)
+    client = FakeSlackClient()
+    scheduler.submit("C1", "0", "busy")
+    scheduler.submit("C1", "1", "Hel …", partial=True)
+    scheduler.submit("C1", "1", "Hello world")
+    _run(scheduler, client, [])
+    assert client.calls == [("post", "C1", "busy"), ("post", "C1", "Hello world")]
+
+
+def test_sink_handler_confirms_partial_replies(client):
+    with client.websocket_connect("/sink?partial=1") as session:
+        assert json.loads(session.receive_text()) == {"type": "partial"}
+
+
+def test_subscription_filters_channels_and_mentions():
+    subscription = Subscription.from_query_params(
+        {"channels": "C1,C2", "mentions_only": "1", "mention": "<@B>"}
+    )
+    assert subscription.accepts({"channel": "C1", "text": "<@B> hi"})
+    assert not subscription.accepts({"channel": "C1", "text": "hi"})
+    assert not subscription.accepts({"channel": "C3", "text": "<@B> hi"})
+
+
+def test_source_handler_only_sends_subscribed_events(client):
+    query = "channels=C1,C2&mentions_only=1&mention=%3C%40B%3E"
+    with client.websocket_connect(f"/source?{query}") as session:
+        _wait_until(lambda: proxy.SOURCE_QUEUES)
+        _distribute(
+            session,
+            {"channel": "C3", "ts": "1.0", "text": "<@B> elsewhere"},
+            {"channel": "C1", "ts": "2.0", "text": "no mention"},
+            {"channel": "C2", "ts": "3.0", "text": "<@B> hi"},
+            {"channel": "C1", "ts": "4.0", "text": "<@B> hello"},
+        )
+        frames = [json.loads(session.receive_bytes()) for _ in range(2)]
+    assert [event["ts"] for event in frames] == ["3.0", "4.0"]
+
+
+def test_source_handler_rejects_bad_subscriptions(client):
+    with client.websocket_connect("/source?schema=tiny") as session:
+        message = session.receive()
+    assert message["type"] == "websocket.close"
+    assert message["code"] == 1008
+
+
+def test_encoded_event_keeps_each_encoding():
+    event = {"channel": "C1", "ts": "1.0", "user": "U1", "text": "hi", "team": "T1"}
+    encoded = EncodedEvent(event)
+    assert json.loads(encoded.encode("full")) == event
+    assert json.loads(encoded.encode("compact")) == {
+        "channel": "C1",
+        "ts": "1.0",
+        "user": "U1",
+        "text": "hi",
+    }
+    (record,) = wire.decode_records(encoded.encode("records"), wire.SOURCE_FIELDS)
+    assert record == json.loads(encoded.encode("compact"))
+    assert encoded.encode("compact") is encoded.encode("compact")
+
+
+def test_events_are_serialized_once_for_all_listeners(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    serialized = []
+
+    def _dumps(data):
+        serialized.append(data)
+        return json.dumps(data)
+
+    monkeypatch.setattr(proxy, "json", types.SimpleNamespace(dumps=_dumps))
+    encodings = ["full", "compact", "records", "compact", "full", "records"]
+    subscriptions = {
+        Address("127.0.0.1", i): Subscription(
+            schema="full" if encoding == "full" else "compact",
+            format="records" if encoding == "records" else "json",
+        )
+        for i, encoding in enumerate(encodings)
+    }
+    queues = {client: ListenerQueue() for client in subscriptions}
+    monkeypatch.setattr(proxy, "SUBSCRIPTIONS", subscriptions)
+    monkeypatch.setattr(proxy, "SOURCE_QUEUES", queues)
+
+    event = {"channel": "C1", "ts": "1.0", "user": "U1", "text": "hi", "team": "T1"}
+
+    async def _main():
+        await proxy.distribute_message_to_listeners({"event": event}, None)
+        return [(await queue.get_batch(1))[0] for queue in queues.values()]
+
+    frames = asyncio.run(_main())
+    assert len(serialized) == 2
+    assert frames[0] is frames[4]
+    assert frames[1] is frames[3]
+    assert frames[2] is frames[5]
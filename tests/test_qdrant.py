@@ -0,0 +1,335 @@
+import multiprocessing
+import pathlib
+import random
+import socket
+import time
+
+import numpy as np
+import pytest
+from qdrant_client import QdrantClient
+
+from conftest import MODEL
+from conftest import StubEmbedding
+from utils.qdrant import DocumentDatabase
+from utils.qdrant import _chunk_text
+from utils.qdrant import connect_document_database
+from utils.qdrant import serve_document_database
+
+
+def _reference_chunks(text: str, chunk_length: int, overlap: int) -> list[str]:
+    # Chunks of the whole text at once: paragraphs, and windows of long ones
+    chunks = []
+    for paragraph in text.split("\n\n"):
+        start = 0
+        while True:
+            chunks.append(paragraph[start : start + chunk_length])
+            if start + chunk_length >= len(paragraph):
+                break
+            start += chunk_length - overlap
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def test_chunk_text_splits_paragraphs():
+    text = "First paragraph.\n\nSecond one.\n\n\n\nThird."
+    assert list(_chunk_text([text], 700, 200)) == [
+        "First paragraph.",
+        "Second one.",
+        "Third.",
+    ]
+
+
+def test_chunk_text_windows_long_paragraphs():
+    text = "short\n\n" + "abcdefghij" * 3
+    assert list(_chunk_text([text], 12, 4)) == [
+        "short",
+        "abcdefghijab",
+        "ijabcdefghij",
+        "ghijabcdefgh",
+        "efghij",
+    ]
+
+
+def test_chunk_text_does_not_depend_on_pieces():
+    rng = random.Random(0)
+    for _ in range(500):
+        text = "".join(
+            rng.choice(["word", " ", "\n", "\n\n", "x"]) for _ in range(200)
+        )
+        chunk_length = rng.randrange(5, 40)
+        overlap = rng.randrange(0, chunk_length - 1)
+        cuts = sorted(rng.sample(range(len(text)), rng.randrange(0, 8)))
+        pieces = [text[i:j] for i, j in zip([0, *cuts], [*cuts, len(text)])]
+
+        expected = _reference_chunks(text, chunk_length, overlap)
+        assert list(_chunk_text(pieces, chunk_length, overlap)) == expected
+
+
+def test_chunk_text_rejects_overlaps_that_dont_advance():
+    for chunk_length, overlap in [(10, 10), (10, 12), (10, -1), (0, 0)]:
+        with pytest.raises(ValueError):
+            _chunk_text(["text"], chunk_length, overlap)
+
+
+def test_ingest_directory_chunks_files_in_parallel(
+    tmp_path: pathlib.Path, embedding_model
+):
+    for i in range(6):
+        paragraphs = [f"File {i} paragraph {j}." for j in range(3)]
+        (tmp_path / f"doc{i}.txt").write_text("\n\n".join(paragraphs))
+    (tmp_path / "skipped.md").write_text("Not a text file.")
+
+    serial = DocumentDatabase(model=MODEL)
+    parallel = DocumentDatabase(model=MODEL)
+    assert serial.ingest_directory(str(tmp_path), workers=1)["chunks"] == 18
+    stats = parallel.ingest_directory(str(tmp_path), workers=2)
+    assert (stats["files"], stats["chunks"], stats["new_chunks"]) == (6, 18, 18)
+    assert parallel.search("File 3 paragraph 1", 1) == serial.search(
+        "File 3 paragraph 1", 1
+    )
+
+    # Ingesting the same files again has nothing to embed
+    stats = parallel.ingest_directory(str(tmp_path), workers=2)
+    assert (stats["new_chunks"], stats["deleted_chunks"]) == (0, 0)
+
+
+def test_upsert_only_embeds_changed_chunks(document_database, embedding_model):
+    text = "Windows collect items.\n\nJoins combine streams.\n\nState is kept."
+    assert document_database.upsert_document("guide.txt", text) == {
+        "kept": 0,
+        "added": 3,
+        "deleted": 0,
+    }
+
+    embedding_model.embedded.clear()
+    edited = text.replace("Joins combine streams.", "Joins merge streams by key.")
+    assert document_database.upsert_document("guide.txt", edited) == {
+        "kept": 2,
+        "added": 1,
+        "deleted": 1,
+    }
+    assert embedding_model.embedded == ["passage: Joins merge streams by key."]
+    assert "Joins combine streams." not in document_database.search("joins", 3)
+
+
+def test_delete_document(document_database):
+    document_database.upsert_document("a.txt", "Windows collect items.")
+    document_database.upsert_document("b.txt", "Joins combine streams.")
+    assert document_database.delete_document("a.txt") == 1
+    assert document_database.delete_document("a.txt") == 0
+    assert document_database.search("windows collect items", 5) == [
+        "Joins combine streams."
+    ]
+
+
+def test_ingested_directory_is_kept_by_upserts(
+    tmp_path: pathlib.Path, document_database, embedding_model
+):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.txt").write_text("Windows collect items.\n\n" + "long " * 300)
+    (tmp_path / "sub" / "b.txt").write_text("Joins combine streams.")
+    stats = document_database.ingest_directory(str(tmp_path), workers=1)
+    assert stats["files"] == 2
+    assert stats["new_chunks"] == stats["chunks"]
+
+    # The same chunks under the same sources, nothing to embed
+    embedding_model.embedded.clear()
+    for path in tmp_path.rglob("*.txt"):
+        source = path.relative_to(tmp_path).as_posix()
+        counts = document_database.upsert_document(source, path.read_text())
+        assert counts["added"] == counts["deleted"] == 0
+    assert embedding_model.embedded == []
+
+    # Re-ingesting a changed file replaces its stale chunks
+    (tmp_path / "sub" / "b.txt").write_text("Joins merge streams by key.")
+    stats = document_database.ingest_directory(str(tmp_path), workers=1)
+    assert (stats["new_chunks"], stats["deleted_chunks"]) == (1, 1)
+    assert document_database.search("joins", 1) == ["Joins merge streams by key."]
+
+
+def test_hybrid_search_finds_exact_terms(embedding_model):
+    database = DocumentDatabase(hybrid=True)
+    database.upsert_document(
+        "flags.txt",
+        "Set --zebra-mode to enable turbo.\n\nThe stream is keyed by channel.",
+    )
+    assert database.search("--zebra-mode", 1) == ["Set --zebra-mode to enable turbo."]
+    assert database.search("how is the stream keyed", 1) == [
+        "The stream is keyed by channel."
+    ]
+
+
+def test_stored_vectors_are_reused_after_a_restart(
+    tmp_path: pathlib.Path, embedding_model
+):
+    text = "Windows collect items.\n\nJoins combine streams."
+    database = DocumentDatabase(path=str(tmp_path))
+    database.upsert_document("guide.txt", text)
+    database._client.close()
+    assert len(embedding_model.embedded) == 2
+
+    embedding_model.embedded.clear()
+    database = DocumentDatabase(path=str(tmp_path))
+    assert database.upsert_document("guide.txt", text)["kept"] == 2
+    assert embedding_model.embedded == []
+    assert database.search("joins", 1) == ["Joins combine streams."]
+
+
+def test_sharing_requires_an_authkey(document_database):
+    with pytest.raises(ValueError):
+        serve_document_database(document_database, "127.0.0.1:0", b"")
+    with pytest.raises(ValueError):
+        connect_document_database("127.0.0.1:1", b"")
+
+
+WEIGHTS_MIB = 64
+
+
+class _LoadedModel(StubEmbedding):
+    # Takes up as much memory as the weights of an embedding model
+    def __init__(self):
+        super().__init__()
+        self.weights = np.ones(WEIGHTS_MIB * 2**20 // 8)
+
+
+def _private_mib(pid: int | str = "self") -> float:
+    # Memory not shared with the parent process, which the workers fork from
+    rollup = pathlib.Path(f"/proc/{pid}/smaps_rollup").read_text()
+    private = sum(
+        int(line.split()[1])
+        for line in rollup.splitlines()
+        if line.startswith(("Private_Clean:", "Private_Dirty:"))
+    )
+    return private / 1024
+
+
+def _loaded_database() -> DocumentDatabase:
+    QdrantClient.embedding_models[MODEL] = _LoadedModel()
+    database = DocumentDatabase(model=MODEL)
+    database.upsert_document("guide.txt", "Windows collect items.")
+    return database
+
+
+def _search(database: DocumentDatabase, results) -> None:
+    assert database.search("windows", 1) == ["Windows collect items."]
+    results.put(_private_mib())
+
+
+def _own_database(results) -> None:
+    _search(_loaded_database(), results)
+
+
+def _served_database(address: str, authkey: bytes) -> None:
+    serve_document_database(_loaded_database(), address, authkey)
+
+
+def _shared_database(address: str, authkey: bytes, results) -> None:
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            database = connect_document_database(address, authkey)
+            break
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline, "database not served"
+            time.sleep(0.05)
+    _search(database, results)
+
+
+def _run_workers(context, target, args, workers: int) -> list[float]:
+    # Private memory of each of the workers, after searching
+    results = context.Queue()
+    processes = [
+        context.Process(target=target, args=(*args, results)) for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    private = [results.get(timeout=30) for _ in processes]
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    return private
+
+
+@pytest.mark.skipif(
+    not pathlib.Path("/proc/self/smaps_rollup").exists(),
+    reason="measures memory with /proc",
+)
+@pytest.mark.parametrize("workers", [1, 8])
+def test_workers_sharing_a_database_load_one_model(workers: int):
+    context = multiprocessing.get_context("fork")
+    own = _run_workers(context, _own_database, (), workers)
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        address = "127.0.0.1:%d" % sock.getsockname()[1]
+    server = context.Process(target=_served_database, args=(address, b"secret"))
+    server.start()
+    try:
+        shared = _run_workers(context, _shared_database, (address, b"secret"), workers)
+        served = _private_mib(server.pid)
+    finally:
+        server.terminate()
+        server.join()
+
+    # Every worker with a database of its own loads the model, while workers
+    # sharing one only add their connection to the model of the server
+    assert min(own) > WEIGHTS_MIB
+    assert served > WEIGHTS_MIB
+    assert max(shared) < WEIGHTS_MIB / 4
+    assert served + sum(shared) < sum(own) - (workers - 2) * WEIGHTS_MIB
+
+
+DOCUMENTS = {
+    "windows.txt": "Tumbling windows split a stream into fixed intervals.\n\n"
+    "Sliding windows overlap.",
+    "joins.txt": "Joins combine streams by key.\n\nA running join keeps state.",
+    "flags.txt": "Set --zebra-mode to enable turbo.",
+}
+QUERIES = [
+    "how do tumbling windows work",
+    "joins",
+    "--zebra-mode",
+    "joins",
+    "state of a running join",
+]
+
+
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_search_batch_finds_what_single_searches_find(embedding_model, hybrid: bool):
+    # Without caches, so that every search really searches
+    databases = [DocumentDatabase(cache_size=0, hybrid=hybrid) for _ in range(2)]
+    for database in databases:
+        for source, text in DOCUMENTS.items():
+            database.upsert_document(source, text)
+
+    embedding_model.calls = 0
+    batched = databases[0].search_batch(QUERIES, limit=3)
+    assert embedding_model.calls <= 1
+    assert batched == [databases[1].search(query, limit=3) for query in QUERIES]
+    assert batched[0][0].startswith("Tumbling windows")
+
+
+def test_search_results_are_cached_until_documents_change(document_database):
+    document_database.upsert_document("a.txt", "Windows collect items.")
+    assert document_database.search("windows", 5) == ["Windows collect items."]
+    assert document_database.cache_stats()["results"]["hits"] == 0
+    assert document_database.search("Windows ", 5) == ["Windows collect items."]
+    assert document_database.cache_stats()["results"]["hits"] == 1
+
+    document_database.upsert_document("b.txt", "Windows close on time.")
+    assert len(document_database.search("windows", 5)) == 2
+
+
+def test_results_of_a_search_overlapping_a_change_are_not_cached(document_database):
+    document_database.upsert_document("a.txt", "Windows collect items.")
+    vector_search = document_database._vector_search
+
+    def _search_then_upsert(queries, limit):
+        results = vector_search(queries, limit)
+        # Another worker changes the documents before this search is done
+        document_database.upsert_document("b.txt", "Windows close on time.")
+        return results
+
+    document_database._vector_search = _search_then_upsert
+    assert document_database.search("windows", 5) == ["Windows collect items."]
+    document_database._vector_search = vector_search
+    assert len(document_database.search("windows", 5)) == 2
@@ -0,0 +1,171 @@
+import contextlib
+import json
+import threading
+import time
+from datetime import datetime
+from datetime import timezone
+
+import pytest
+
+from utils import wire
+from utils.connectors.slack import SlackMessage
+from utils.connectors.slack import SlackUpdates
+from utils.connectors.slack import sink
+from utils.connectors.slack.sink import _SlackSinkPartition
+
+
+def _wait_until(predicate, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def _reply(i: int) -> SlackMessage:
+    return SlackMessage(
+        id=f"{i}.0",
+        user="bot",
+        channel="C1",
+        text=f"reply {i}",
+        timestamp=datetime.now(timezone.utc),
+    )
+
+
+@contextlib.contextmanager
+def _partition(proxy, **kwargs):
+    partition = _SlackSinkPartition(f"{proxy.url}/sink", **kwargs)
+    try:
+        yield partition
+    finally:
+        partition.close()
+
+
+@pytest.fixture
+def connected(monkeypatch: pytest.MonkeyPatch) -> threading.Event:
+    # Holds partitions back from connecting until set, so that replies can be
+    # queued before the sender takes its first batch
+    event = threading.Event()
+    connect = sink.connect
+
+    def _connect(*args):
+        event.wait()
+        return connect(*args)
+
+    monkeypatch.setattr(sink, "connect", _connect)
+    return event
+
+
+def test_replies_are_sent_as_soon_as_they_are_written(proxy):
+    with _partition(proxy) as partition:
+        _wait_until(lambda: proxy.connections)
+        for i in range(3):
+            start = time.monotonic()
+            partition.write_batch([_reply(i)])
+            _wait_until(lambda: len(proxy.received) == i + 1)
+            assert time.monotonic() - start < 0.5
+
+    assert [json.loads(frame)["text"] for frame in proxy.received] == [
+        "reply 0",
+        "reply 1",
+        "reply 2",
+    ]
+
+
+def test_queued_replies_are_coalesced_into_one_frame(proxy, connected):
+    with _partition(proxy, coalesce=True) as partition:
+        partition.write_batch([_reply(i) for i in range(3)])
+        connected.set()
+        _wait_until(lambda: proxy.received)
+
+    (frame,) = proxy.received
+    assert [reply["text"] for reply in json.loads(frame)] == [
+        "reply 0",
+        "reply 1",
+        "reply 2",
+    ]
+
+
+def test_queued_records_are_coalesced_into_one_frame(proxy, connected):
+    with _partition(proxy, coalesce=True, wire_format="records") as partition:
+        partition.write_batch([_reply(i) for i in range(3)])
+        connected.set()
+        _wait_until(lambda: proxy.received)
+
+    (frame,) = proxy.received
+    records = wire.decode_records(frame, wire.SINK_FIELDS)
+    assert [record["text"] for record in records] == ["reply 0", "reply 1", "reply 2"]
+
+
+def test_batches_are_capped_at_the_batch_size(proxy, connected):
+    with _partition(proxy, coalesce=True, max_batch_size=2) as partition:
+        partition.write_batch([_reply(i) for i in range(5)])
+        connected.set()
+        _wait_until(lambda: len(proxy.received) == 3)
+
+    frames = [json.loads(frame) for frame in proxy.received]
+    assert [[reply["text"] for reply in frame] for frame in frames[:2]] == [
+        ["reply 0", "reply 1"],
+        ["reply 2", "reply 3"],
+    ]
+    assert frames[2]["text"] == "reply 4"
+
+
+def test_replies_are_resent_after_reconnecting(proxy):
+    with _partition(proxy) as partition:
+        partition.write_batch([_reply(1)])
+        _wait_until(lambda: len(proxy.received) == 1)
+
+        # The reply written while the proxy restarts is sent once reconnected
+        proxy.drop_connections()
+        time.sleep(0.1)
+        partition.write_batch([_reply(2)])
+        _wait_until(lambda: len(proxy.received) == 2)
+
+    assert len(proxy.connections) == 2
+    assert [json.loads(frame)["text"] for frame in proxy.received] == [
+        "reply 1",
+        "reply 2",
+    ]
+
+
+def test_close_flushes_queued_replies(proxy, connected):
+    partition = _SlackSinkPartition(f"{proxy.url}/sink")
+    partition.write_batch([_reply(i) for i in range(3)])
+    connected.set()
+    partition.close()
+    assert not partition._thread.is_alive()
+    _wait_until(lambda: len(proxy.received) == 3)
+
+
+def test_updates_connect_on_the_first_update(proxy):
+    updates = SlackUpdates(proxy.url)
+    try:
+        time.sleep(0.1)
+        assert not proxy.connections
+
+        updates.send(_reply(1))
+        _wait_until(lambda: proxy.received)
+        assert updates._partition.supports_partial
+        assert "partial=1" in proxy.paths[0]
+        assert json.loads(proxy.received[0]) == {
+            "ts": "1.0",
+            "text": "reply 1",
+            "channel": "C1",
+            "partial": "1",
+        }
+    finally:
+        updates.close()
+
+
+def test_updates_are_dropped_unless_the_proxy_supports_them(proxy):
+    # Older proxies would post every update as a new message
+    proxy.greet = False
+    updates = SlackUpdates(proxy.url, greeting_timeout=0.2)
+    try:
+        updates.send(_reply(1))
+        _wait_until(lambda: updates._partition.supports_partial is False)
+        updates.send(_reply(2))
+        assert updates._partition._queue.qsize() == 1
+    finally:
+        updates.close()
+    assert proxy.received == []
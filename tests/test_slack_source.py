@@ -0,0 +1,128 @@
+import contextlib
+import json
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from utils.connectors.slack.source import SlackSource
+from utils.connectors.slack.source import _SlackSourcePartition
+
+
+def _wait_until(predicate, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def _event(i: int, channel: str = "C1") -> bytes:
+    event = {"channel": channel, "ts": f"{i}.0", "user": "U1", "text": f"hi {i}"}
+    return json.dumps(event).encode("utf-8")
+
+
+@contextlib.contextmanager
+def _partition(proxy, worker_index: int = 0, **kwargs):
+    partition = _SlackSourcePartition(
+        f"{proxy.url}/source?worker_index={worker_index}",
+        worker_index=worker_index,
+        **kwargs,
+    )
+    try:
+        _wait_until(lambda: proxy.connections)
+        yield partition
+    finally:
+        # Let the receiver hang up before the stand-in shuts down
+        partition.close()
+        partition._thread.join()
+
+
+def _drain(partition: _SlackSourcePartition) -> list[int]:
+    # Sizes of the batches emitted until the queue is empty, which must all
+    # ask to be woken again right away
+    sizes = []
+    now = datetime.now(timezone.utc)
+    while batch := list(partition.next_batch(now)):
+        sizes.append(len(batch))
+        assert partition.next_awake() is None
+    return sizes
+
+
+def test_next_batch_drains_the_queue_up_to_the_batch_size(proxy):
+    proxy.frames = [_event(i) for i in range(25)]
+    with _partition(proxy, max_batch_size=10) as partition:
+        _wait_until(lambda: partition._queue.qsize() == 25)
+        assert _drain(partition) == [10, 10, 5]
+
+
+def test_next_batch_drains_the_queue_up_to_the_byte_budget(proxy):
+    proxy.frames = [_event(i) for i in range(7)]
+    with _partition(proxy, max_batch_bytes=3 * len(_event(0))) as partition:
+        _wait_until(lambda: partition._queue.qsize() == 7)
+        assert _drain(partition) == [3, 3, 1]
+
+
+def test_next_awake_backs_off_only_while_idle(proxy):
+    with _partition(
+        proxy,
+        min_backoff=timedelta(milliseconds=100),
+        max_backoff=timedelta(milliseconds=400),
+    ) as partition:
+        now = datetime.now(timezone.utc)
+        delays = []
+        for _ in range(4):
+            assert list(partition.next_batch(now)) == []
+            delay = partition.next_awake() - datetime.now(timezone.utc)
+            delays.append(round(delay.total_seconds(), 1))
+        assert delays == [0.1, 0.2, 0.4, 0.4]
+
+        # The first message wakes the partition up again right away
+        partition._queue.put(_event(1))
+        assert [msg.text for msg in partition.next_batch(now)] == ["hi 1"]
+        assert partition.next_awake() is None
+        assert list(partition.next_batch(now)) == []
+        delay = partition.next_awake() - datetime.now(timezone.utc)
+        assert round(delay.total_seconds(), 1) == 0.1
+
+
+def test_every_partition_connects_as_its_worker(proxy):
+    source = SlackSource(proxy.url, routing="channel")
+    now = datetime.now(timezone.utc)
+    partitions = [source.build(now, i, 3) for i in range(3)]
+    try:
+        _wait_until(lambda: len(proxy.connections) == 3)
+        queries = [parse_qs(urlsplit(path).query) for path in proxy.paths]
+        assert sorted(query["worker_index"][0] for query in queries) == ["0", "1", "2"]
+        assert all(query["worker_count"] == ["3"] for query in queries)
+        assert all(query["routing"] == ["channel"] for query in queries)
+    finally:
+        for partition in partitions:
+            partition.close()
+        for partition in partitions:
+            partition._thread.join()
+
+
+def test_greeting_proxy_is_not_mistaken_for_an_event(proxy):
+    proxy.frames = [_event(1)]
+    with _partition(proxy, worker_index=1) as partition:
+        _wait_until(lambda: partition._queue.qsize() == 1)
+        assert not partition._legacy
+        assert [msg.text for msg in partition.next_batch(None)] == ["hi 1"]
+
+
+def test_legacy_proxy_is_only_received_from_by_the_first_worker(proxy):
+    # Older proxies send every event as JSON, to every connection
+    proxy.greet = False
+    proxy.frames = [_event(1)]
+    with _partition(proxy, worker_index=1, wire_format="records") as other:
+        other._thread.join(timeout=5)
+        assert not other._thread.is_alive()
+        assert other._queue.qsize() == 0
+
+    proxy.frames = [_event(1), _event(2)]
+    with _partition(proxy, worker_index=0, wire_format="records") as first:
+        _wait_until(lambda: first._queue.qsize() == 2)
+        assert first._legacy
+        assert [msg.text for msg in first.next_batch(None)] == ["hi 1", "hi 2"]
@@ -0,0 +1,334 @@
+import asyncio
+import contextlib
+import importlib
+import pathlib
+import time
+import types
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+import bytewax.operators as op
+import pytest
+from bytewax.dataflow import Dataflow
+from bytewax.testing import TestingSink
+from bytewax.testing import TestingSource
+from bytewax.testing import run_main
+
+from utils.cache import SemanticCache
+from utils.connectors.slack import SlackMessage
+from utils.qdrant import DocumentDatabase
+
+ROOT = pathlib.Path(__file__).parent.parent
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _completion(content: str):
+    message = types.SimpleNamespace(content=content)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+class FakeSummaryLLM:
+    """Summarizes by listing the users' lines after the previous summary."""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, model, messages, max_tokens, **kwargs):
+        self.calls += 1
+        previous = messages[0]["content"].split("current summary:")[1].strip()
+        return _completion(f"{previous} | {messages[1]['content'].strip()}")
+
+
+class FakeAnswerLLM:
+    """Answers with the question and the prompt it was given.
+
+    A question ending in a number of seconds takes that long to answer.
+    """
+
+    def __init__(self, stream_words: int = 3):
+        self.calls = 0
+        self.stream_words = stream_words
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, max_tokens, stream=False):
+        self.calls += 1
+        question = messages[1]["content"]
+        delay = question.rsplit(maxsplit=1)[-1]
+        if delay.replace(".", "", 1).isdigit():
+            await asyncio.sleep(float(delay))
+
+        answer = f"Answer to {question!r} given {messages[0]['content']!r}"
+        if not stream:
+            return _completion(answer)
+        return self._stream(answer)
+
+    async def _stream(self, answer: str):
+        words = answer.split(" ")
+        size = max(1, len(words) // self.stream_words)
+        for i in range(0, len(words), size):
+            delta = types.SimpleNamespace(content=" ".join(words[i : i + size]) + " ")
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+
+
+class FakeUpdates:
+    def __init__(self):
+        self.sent: list[SlackMessage] = []
+
+    def send(self, msg: SlackMessage) -> None:
+        self.sent.append(msg)
+
+
+@pytest.fixture
+def step6(monkeypatch: pytest.MonkeyPatch, embedding_model):
+    # Importing step6 builds its dataflow, which needs the settings of .env
+    for name, value in {
+        "LLM_ENDPOINT": "http://llm.invalid",
+        "LLM_DEPLOYMENT": "test",
+        "OPENAI_API_KEY": "test",
+        "YOKOTAI_APIKEY": "test",
+        "SLACK_PROXY_URL": "ws://proxy.invalid",
+        "SLACK_CHANNEL_IDS": "*",
+        "DOCUMENT_DB_PATH": "",
+    }.items():
+        monkeypatch.setenv(name, value)
+    for name in [
+        "DOCUMENT_DB_ADDRESS",
+        "DOCUMENTS_DIR",
+        "STREAM_RESPONSES",
+        "ANSWER_CACHE_THRESHOLD",
+    ]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.chdir(ROOT)
+
+    module = importlib.import_module("step6")
+    monkeypatch.setattr(module, "_create_llm_client", FakeSummaryLLM)
+    monkeypatch.setattr(module, "_create_async_llm_client", FakeAnswerLLM)
+    return module
+
+
+def _message(i: int, channel: str, text: str, seconds: float = 0) -> SlackMessage:
+    return SlackMessage(
+        id=str(i),
+        user=f"U{i}",
+        channel=channel,
+        text=text,
+        timestamp=START + timedelta(seconds=seconds),
+    )
+
+
+def _window(*messages: SlackMessage):
+    return (None, list(messages))
+
+
+def test_summarizer_waits_for_enough_messages(step6):
+    summarizer = step6.Summarizer(max_pending_messages=3)
+    state = summarizer.create_initial_state()
+    state = summarizer(state, _window(_message(1, "C", "hi")))
+    state = summarizer(state, _window(_message(2, "C", "hello")))
+    assert summarizer._llm_client.calls == 0
+    assert state.summary == "No-one has said anything yet."
+
+    state = summarizer(state, _window(_message(3, "C", "windows?")))
+    assert summarizer._llm_client.calls == 1
+    assert state.summary == (
+        "No-one has said anything yet. | - U1: hi\n - U2: hello\n - U3: windows?"
+    )
+    assert state.pending == []
+
+
+def test_summarizer_summarizes_stale_messages(step6):
+    summarizer = step6.Summarizer(max_staleness=timedelta(seconds=30))
+    state = summarizer.create_initial_state()
+    state = summarizer(state, _window(_message(1, "C", "hi", seconds=0)))
+    assert summarizer._llm_client.calls == 0
+    state = summarizer(state, _window(_message(2, "C", "later", seconds=31)))
+    assert summarizer._llm_client.calls == 1
+
+
+def test_summarizer_flush(step6):
+    summarizer = step6.Summarizer()
+    state = summarizer.create_initial_state()
+    assert summarizer.flush(state) is state
+    assert summarizer._llm_client.calls == 0
+
+    state = summarizer(state, _window(_message(1, "C", "hi")))
+    state = summarizer.flush(state)
+    assert summarizer._llm_client.calls == 1
+    assert state.summary.endswith("- U1: hi")
+
+
+def _question(step6, i: int, text: str, channel: str = "C"):
+    return step6.AugmentedMessage(
+        message=_message(i, channel, text),
+        related_summary="summary",
+        related_context=["context"],
+    )
+
+
+def _wait_until(predicate, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_generator_limits_concurrency(step6):
+    for max_concurrency, bounds in [(1, (0.3, 1)), (3, (0.1, 0.2))]:
+        generator = step6.Generator(max_concurrency=max_concurrency)
+        with contextlib.closing(generator):
+            start = time.perf_counter()
+            questions = [_question(step6, i, f"q{i} 0.1") for i in range(3)]
+            futures = [generator.submit(question) for question in questions]
+            assert time.perf_counter() - start < 0.05
+            assert [future.result().id for future in futures] == ["0", "1", "2"]
+            low, high = bounds
+            assert low <= time.perf_counter() - start < high
+
+
+def test_generator_answers_similar_questions_from_cache(step6, embedding_model):
+    database = DocumentDatabase()
+    cache = SemanticCache(database.embed_queries, threshold=0.95)
+    with contextlib.closing(step6.Generator(cache)) as generator:
+        first = generator.submit(_question(step6, 1, "How do windows work?")).result()
+        second = generator.submit(_question(step6, 2, "how do windows work")).result()
+
+        assert generator._llm_client.calls == 1
+    assert second.text == first.text
+    assert second.id == "2"
+
+
+def test_responses_are_emitted_in_order_once_ready(step6):
+    with contextlib.closing(step6.Generator()) as generator:
+        channel = step6._InFlightResponses(generator, timedelta(0))
+        other = step6._InFlightResponses(generator, timedelta(0))
+
+        # Submitting doesn't wait for the completions
+        start = time.perf_counter()
+        assert channel.on_item(START, _question(step6, 1, "slow 0.3")) == ([], False)
+        assert channel.on_item(START, _question(step6, 2, "fast 0.05")) == ([], False)
+        assert other.on_item(START, _question(step6, 3, "fast 0.05", "D"))[0] == []
+        assert time.perf_counter() - start < 0.05
+        assert channel.notify_at() is not None
+
+        # The fast response of the channel waits for the slow one before it,
+        # but not the one of the other channel
+        time.sleep(0.15)
+        assert channel.on_notify(START) == ([], False)
+        responses, discard = other.on_notify(START)
+        assert [response.id for response in responses] == ["3"]
+        assert discard and other.notify_at() is None
+
+        _wait_until(lambda: channel._pending[0].done())
+        responses, discard = channel.on_notify(START)
+        assert [response.id for response in responses] == ["1", "2"]
+        assert discard and channel.notify_at() is None
+
+
+def test_generate_responses_keeps_questions_in_flight(step6):
+    questions = [
+        _question(step6, 1, "slow 0.3"),
+        _question(step6, 2, "fast 0.1"),
+        _question(step6, 3, "slow 0.3", "D"),
+        _question(step6, 4, "fast 0.1", "D"),
+    ]
+    replies = []
+    flow = Dataflow("test")
+    stream = op.input("input", flow, TestingSource(questions))
+    keyed = op.key_on("key", stream, lambda question: question.message.channel)
+    with contextlib.closing(step6.Generator()) as generator:
+        responses = step6.generate_responses("generate", keyed, generator)
+        op.output("output", responses, TestingSink(replies))
+
+        start = time.perf_counter()
+        run_main(flow)
+        # The questions arrive one by one, but are answered concurrently
+        assert time.perf_counter() - start < 0.6
+
+    assert [(channel, reply.id) for channel, reply in replies if channel == "C"] == [
+        ("C", "1"),
+        ("C", "2"),
+    ]
+    assert [(channel, reply.id) for channel, reply in replies if channel == "D"] == [
+        ("D", "3"),
+        ("D", "4"),
+    ]
+
+
+def test_generator_streams_partial_responses(step6):
+    updates = FakeUpdates()
+    generator = step6.Generator(updates=updates, update_interval=0)
+    with contextlib.closing(generator):
+        response = generator.submit(_question(step6, 1, "Stream this")).result()
+
+    assert len(updates.sent) >= 2
+    assert all(update.id == "1" for update in updates.sent)
+    assert all(update.text.endswith(" …") for update in updates.sent)
+    assert response.text.startswith("Answer to 'Stream this'")
+    assert updates.sent[-1].text == f"{response.text} …"
+
+
+def _guide() -> DocumentDatabase:
+    database = DocumentDatabase()
+    database.upsert_document(
+        "guide.txt",
+        "Tumbling windows split a stream into fixed intervals.\n\n"
+        "The zebrafrobnicator flag enables turbo mode.",
+    )
+    return database
+
+
+def _run_dataflow(step6, monkeypatch, database, messages) -> list[SlackMessage]:
+    replies: list[SlackMessage] = []
+    monkeypatch.setattr(step6, "_create_document_storage", lambda: database)
+    monkeypatch.setattr(step6, "SlackSource", lambda **kwargs: TestingSource(messages))
+    monkeypatch.setattr(step6, "SlackSink", lambda **kwargs: TestingSink(replies))
+    run_main(step6._build_dataflow())
+    return replies
+
+
+def test_dataflow_summarizes_each_channel_separately(
+    step6, monkeypatch: pytest.MonkeyPatch, embedding_model
+):
+    mention = step6.BOT_MENTION
+    messages = [
+        _message(1, "C1", "windows are great", seconds=0),
+        _message(2, "C2", "joins are great", seconds=1),
+        # Close the windows of the messages above
+        _message(3, "C1", "so", seconds=11),
+        _message(4, "C2", "so", seconds=11),
+        _message(5, "C1", f"{mention} what did we say?", seconds=12),
+        _message(6, "C2", f"{mention} what did we say?", seconds=13),
+    ]
+    replies = _run_dataflow(step6, monkeypatch, _guide(), messages)
+
+    by_channel = {reply.channel: reply.text for reply in replies}
+    assert "windows are great" in by_channel["C1"]
+    assert "joins are great" not in by_channel["C1"]
+    assert "joins are great" in by_channel["C2"]
+    assert "windows are great" not in by_channel["C2"]
+
+
+def test_dataflow_answers_every_question_once(
+    step6, monkeypatch: pytest.MonkeyPatch, embedding_model
+):
+    mention = step6.BOT_MENTION
+    messages = [
+        _message(1, "C1", "hi all", seconds=0),
+        _message(2, "C2", "morning", seconds=1),
+        _message(3, "C1", f"{mention} what is the zebrafrobnicator flag?", seconds=2),
+        _message(4, "C1", "thanks", seconds=3),
+        _message(5, "C2", f"{mention} how do tumbling windows work?", seconds=4),
+        _message(6, "C2", f"{mention} and the zebrafrobnicator flag?", seconds=5),
+    ]
+    replies = _run_dataflow(step6, monkeypatch, _guide(), messages)
+
+    # Replies of a channel are sent in the order the questions were asked
+    ids = {"C1": [], "C2": []}
+    for reply in replies:
+        ids[reply.channel].append(reply.id)
+    assert ids == {"C1": ["3"], "C2": ["5", "6"]}
+    by_id = {reply.id: reply.text for reply in replies}
+    assert "The zebrafrobnicator flag enables turbo mode." in by_id["3"]
+    assert "Tumbling windows split a stream" in by_id["5"]
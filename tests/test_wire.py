@@ -0,0 +1,32 @@
+from utils import wire
+
+
+def test_records_round_trip():
+    records = [
+        {"channel": "C1", "ts": "1.0", "user": "U1", "text": "hello"},
+        {"channel": "C2", "ts": "2.0", "user": "U2", "text": "höhö 🎉\n\"quoted\""},
+    ]
+    frame = wire.encode_records(records, wire.SOURCE_FIELDS)
+    assert list(wire.decode_records(frame, wire.SOURCE_FIELDS)) == records
+
+
+def test_missing_fields_are_empty():
+    frame = wire.encode_record({"channel": "C1", "text": None}, wire.SINK_FIELDS)
+    assert list(wire.decode_records(frame, wire.SINK_FIELDS)) == [
+        {"channel": "C1", "ts": "", "text": "", "partial": ""}
+    ]
+
+
+def test_empty_frame_has_no_records():
+    assert list(wire.decode_records(b"", wire.SOURCE_FIELDS)) == []
+
+
+def test_lengths_count_bytes_not_characters():
+    record = {"channel": "C1", "ts": "1.0", "text": "ääää", "partial": "1"}
+    frame = wire.encode_record(record, wire.SINK_FIELDS)
+    header_size = 4 * len(wire.SINK_FIELDS)
+    assert len(frame) == header_size + len("C1") + len("1.0") + 8 + len("1")
+    assert list(wire.decode_records(frame + frame, wire.SINK_FIELDS)) == [
+        record,
+        record,
+    ]
@@ -0,0 +1,102 @@
+"""An in-memory BM25 inverted index, for lexical search next to the vectors."""
+
+from __future__ import annotations
+
+import collections
+import heapq
+import math
+import re
+import threading
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Split a text into lowercase terms.
+
+    Identifiers and flags are split at punctuation but not at underscores, so
+    "op.stateful_map" gives "op" and "stateful_map".
+    """
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """An inverted index scoring documents with Okapi BM25.
+
+    Documents are added and removed by id. Each term maps to the documents
+    containing it, so a search only looks at the documents sharing a term
+    with the query.
+
+    Args:
+        k1: Term frequency saturation.
+        b: Strength of the document length normalization.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self._k1 = k1
+        self._b = b
+        self._postings: dict[str, dict[str, int]] = collections.defaultdict(dict)
+        self._lengths: dict[str, int] = {}
+        self._texts: dict[str, str] = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def add(self, doc_id: str, text: str) -> None:
+        """Add a document, replacing any document with the same id."""
+        terms = collections.Counter(tokenize(text))
+        with self._lock:
+            self._remove(doc_id)
+            for term, count in terms.items():
+                self._postings[term][doc_id] = count
+            self._lengths[doc_id] = sum(terms.values())
+            self._texts[doc_id] = text
+            self._total_length += self._lengths[doc_id]
+
+    def remove(self, doc_id: str) -> None:
+        """Remove a document, if it is in the index."""
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id: str) -> None:
+        text = self._texts.pop(doc_id, None)
+        if text is None:
+            return
+
+        for term in set(tokenize(text)):
+            postings = self._postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._lengths.pop(doc_id)
+
+    def search(self, query: str, limit: int = 10) -> list[tuple[str, float, str]]:
+        """Find the best matching documents, as (id, score, text), best first.
+
+        The texts are taken together with the scores, so a document removed
+        concurrently is either returned whole or not at all.
+        """
+        scores: dict[str, float] = collections.defaultdict(float)
+        with self._lock:
+            count = len(self._lengths)
+            if not count:
+                return []
+
+            average_length = self._total_length / count
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+
+                matches = len(postings)
+                idf = math.log(1 + (count - matches + 0.5) / (matches + 0.5))
+                for doc_id, frequency in postings.items():
+                    length = self._lengths[doc_id] / average_length
+                    norm = self._k1 * (1 - self._b + self._b * length)
+                    saturation = frequency * (self._k1 + 1) / (frequency + norm)
+                    scores[doc_id] += idf * saturation
+
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [(doc_id, score, self._texts[doc_id]) for doc_id, score in best]
@@ -0,0 +1,154 @@
+"""Small thread-safe caches with expiring entries."""
+from __future__ import annotations
+
+import collections
+import threading
+import time
+from typing import Callable
+from typing import Deque
+from typing import Generic
+from typing import Hashable
+from typing import Optional
+from typing import OrderedDict
+from typing import TypeVar
+
+import numpy as np
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """A least-recently-used cache whose entries also expire after `ttl` seconds.
+
+    Lookups are counted in `hits` and `misses`, for monitoring.
+
+    Args:
+        maxsize: Maximum number of entries, 0 disables the cache.
+        ttl: Seconds an entry stays valid after it was stored, `None` for forever.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, V]] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """Get a cached value, or `None` if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored, value = entry
+                if self._ttl is None or time.monotonic() - stored < self._ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: V) -> None:
+        """Store a value, evicting the least recently used entry if full."""
+        if self._maxsize <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Hit and miss counts and the current size."""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class SemanticCache:
+    """A cache of answers, looked up by the meaning of the question.
+
+    A question is a hit if a previously answered question in the same context
+    has an embedding with at least `threshold` cosine similarity to it, and
+    the answer is at most `max_age` seconds old.
+
+    Lookups are counted in `hits` and `misses`, and the time spent on them in
+    `lookup_seconds`, for monitoring.
+
+    Args:
+        embed: Function computing the embeddings of a list of texts.
+        threshold: Minimum cosine similarity of a matching question.
+        max_age: Seconds an answer may be reused for.
+        maxsize: Maximum number of stored answers.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[list[str]], list[list[float]]],
+        threshold: float = 0.95,
+        max_age: float = 600.0,
+        maxsize: int = 256,
+    ):
+        self._embed = embed
+        self._threshold = threshold
+        self._max_age = max_age
+        self._entries: Deque[tuple[Hashable, np.ndarray, float, str]] = (
+            collections.deque(maxlen=maxsize)
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+
+    def _vector(self, question: str) -> np.ndarray:
+        vector = np.asarray(self._embed([question])[0], dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def get(self, question: str, context: Hashable) -> Optional[str]:
+        """Get the answer to a similar question asked in the same context."""
+        start = time.perf_counter()
+        vector = self._vector(question)
+        now = time.monotonic()
+
+        best_answer, best_score = None, self._threshold
+        with self._lock:
+            for entry_context, entry_vector, stored, answer in self._entries:
+                if entry_context != context or now - stored > self._max_age:
+                    continue
+                score = float(np.dot(vector, entry_vector))
+                if score >= best_score:
+                    best_answer, best_score = answer, score
+
+            if best_answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.lookup_seconds += time.perf_counter() - start
+
+        return best_answer
+
+    def put(self, question: str, context: Hashable, answer: str) -> None:
+        """Store the answer to a question asked in the given context."""
+        vector = self._vector(question)
+        with self._lock:
+            self._entries.append((context, vector, time.monotonic(), answer))
+
+    def stats(self) -> dict[str, float]:
+        """Hit and miss counts, and the average lookup time in seconds."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "average_lookup_seconds": self.lookup_seconds / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,213 @@
+"""Connectors for keeping a `DocumentDatabase` up to date while the dataflow runs."""
+
+from __future__ import annotations
+
+import dataclasses
+import hashlib
+import logging
+import pathlib
+import threading
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from typing import Callable
+from typing import Iterable
+from typing import Optional
+
+from bytewax.inputs import DynamicSource
+from bytewax.inputs import StatelessSourcePartition
+from bytewax.outputs import DynamicSink
+from bytewax.outputs import StatelessSinkPartition
+
+from ..qdrant import DocumentDatabase
+
+log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class Document:
+    """The contents of a new or changed document.
+
+    Fields:
+        source: Path of the document, relative to the watched directory.
+        text: Contents of the document, `None` if it was deleted.
+    """
+
+    source: str
+    text: Optional[str]
+
+
+class _DirectoryScanner:
+    # Finds the new, changed and deleted files of a directory, among those
+    # `owns` accepts. Scanners can be shared by partitions, which then take
+    # turns scanning, and each change is only found by one of them.
+    def __init__(
+        self,
+        root: pathlib.Path,
+        pattern: str,
+        interval: timedelta,
+        owns: Callable[[str], bool],
+    ):
+        self._root = root
+        self._pattern = pattern
+        self._interval = interval
+        self._owns = owns
+        self._lock = threading.Lock()
+
+        # path -> (mtime, size) and content hash of the documents seen so far
+        self._stats: dict[str, tuple[int, int]] = {}
+        self._hashes: dict[str, bytes] = {}
+        self.next_scan = datetime.now(timezone.utc)
+
+    def scan(self) -> list[Document]:
+        with self._lock:
+            if datetime.now(timezone.utc) < self.next_scan:
+                return []
+            self.next_scan = datetime.now(timezone.utc) + self._interval
+            return self._scan()
+
+    def _scan(self) -> list[Document]:
+        batch = []
+        found = set()
+        for path in sorted(self._root.glob(self._pattern)):
+            source = path.relative_to(self._root).as_posix()
+            if not self._owns(source):
+                continue
+            found.add(source)
+
+            try:
+                stat = path.stat()
+                if not path.is_file() or self._stats.get(source) == (
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ):
+                    continue
+                text = path.read_text(encoding="utf-8")
+            except (OSError, UnicodeDecodeError) as e:
+                # Possibly still being written, try again on the next scan
+                log.warning("Could not read %s: %s", path, e)
+                continue
+
+            self._stats[source] = (stat.st_mtime_ns, stat.st_size)
+            digest = hashlib.sha256(text.encode("utf-8")).digest()
+            if self._hashes.get(source) == digest:
+                continue
+            self._hashes[source] = digest
+
+            log.info("Found new or changed document %s", source)
+            batch.append(Document(source=source, text=text))
+
+        for source in self._stats.keys() - found:
+            del self._stats[source]
+            self._hashes.pop(source, None)
+            log.info("Document %s was deleted", source)
+            batch.append(Document(source=source, text=None))
+
+        return batch
+
+
+class _DirectorySourcePartition(StatelessSourcePartition[Document]):
+    def __init__(self, scanner: _DirectoryScanner):
+        self._scanner = scanner
+
+    def next_batch(self, sched: datetime) -> Iterable[Document]:
+        return self._scanner.scan()
+
+    def next_awake(self) -> Optional[datetime]:
+        return self._scanner.next_scan
+
+
+class DirectorySource(DynamicSource[Document]):
+    """Bytewax-compatible source of the new and changed documents of a directory.
+
+    The directory is scanned every `interval`. A file is emitted when it is
+    first seen, and again whenever its contents change. A deleted file is
+    emitted without text.
+
+    Where the documents go decides how the files are divided between the
+    workers. With `shared`, all processes write to one database, so each file
+    is read by one worker, chosen by its path. Otherwise every process has a
+    database of its own, and needs all files: the workers of a process share
+    one scanner, so every process emits each file once.
+
+    Nothing is remembered over restarts, so all files are emitted again after
+    one. Uploading them to a `DocumentDatabase` is cheap though, as chunks that
+    are already stored are not embedded again.
+
+    Args:
+        path: Directory to watch.
+        pattern: Glob pattern of the files to watch, relative to `path`.
+        interval: Time between scans of the directory.
+        shared: Whether the documents go to a database shared by all
+                processes, such as one connected with
+                `connect_document_database`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        pattern: str = "**/*.txt",
+        interval: timedelta = timedelta(seconds=5),
+        shared: bool = False,
+    ):
+        self._root = pathlib.Path(path)
+        self._pattern = pattern
+        self._interval = interval
+        self._shared = shared
+        # The workers of a process build their partitions from this instance
+        self._process_scanner = _DirectoryScanner(
+            self._root, self._pattern, self._interval, lambda source: True
+        )
+
+    def build(
+        self, now: datetime, worker_index: int, worker_count: int
+    ) -> _DirectorySourcePartition:
+        if not self._shared:
+            return _DirectorySourcePartition(self._process_scanner)
+
+        def _owns(source: str) -> bool:
+            # Every file is watched by exactly one worker. CRC32 of paths that
+            # only differ in a digit or two spreads them badly over the workers.
+            digest = hashlib.blake2b(source.encode("utf-8"), digest_size=8).digest()
+            return int.from_bytes(digest, "big") % worker_count == worker_index
+
+        return _DirectorySourcePartition(
+            _DirectoryScanner(self._root, self._pattern, self._interval, _owns)
+        )
+
+
+class _DocumentDatabaseSinkPartition(StatelessSinkPartition[Document]):
+    def __init__(self, document_database: DocumentDatabase):
+        self._document_database = document_database
+
+    def write_batch(self, items: list[Document]) -> None:
+        for document in items:
+            if document.text is None:
+                self._document_database.delete_document(document.source)
+                log.info("Deleted document %s", document.source)
+            else:
+                counts = self._document_database.upsert_document(
+                    document.source, document.text
+                )
+                log.info("Uploaded document %s: %s", document.source, counts)
+
+
+class DocumentDatabaseSink(DynamicSink[Document]):
+    """Bytewax-compatible sink keeping documents in a `DocumentDatabase` current.
+
+    Documents replace their previously stored version, and only the chunks that
+    changed are embedded, so re-uploading a slightly changed document is cheap.
+    Documents without text are deleted.
+
+    Args:
+        document_database: The database to upload to, either a local one or
+                           one connected with `connect_document_database`.
+    """
+
+    def __init__(self, document_database: DocumentDatabase):
+        self._document_database = document_database
+
+    def build(
+        self, worker_index: int, worker_count: int
+    ) -> _DocumentDatabaseSinkPartition:
+        return _DocumentDatabaseSinkPartition(self._document_database)
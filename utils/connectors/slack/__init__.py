@@ -1,6 +1,5 @@
-
-
 from .message import SlackMessage
+from .backpressure import OverflowPolicy
 from .source import SlackSource
 from .sink import SlackSink
-
+from .sink import SlackUpdates
@@ -0,0 +1,140 @@
+"""Bounded queues used between the Slack connectors and the dataflow."""
+from __future__ import annotations
+
+import collections
+import enum
+import logging
+import queue
+import threading
+import time
+from typing import Callable
+from typing import Deque
+from typing import Generic
+from typing import Optional
+from typing import TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class OverflowPolicy(str, enum.Enum):
+    """What to do when a bounded queue is full.
+
+    BLOCK: Wait until there is room, pushing the backpressure upstream.
+    DROP_OLDEST: Discard the oldest queued item to make room for the new one.
+    DROP_NON_MENTIONS: Discard non-mentions first (the new item if it is not a
+                       mention, otherwise the oldest queued non-mention), and
+                       only drop the oldest mention when nothing else is left.
+    """
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop-oldest"
+    DROP_NON_MENTIONS = "drop-non-mentions"
+
+
+class BoundedQueue(Generic[T]):
+    """A thread-safe queue with a size limit and a configurable overflow policy.
+
+    Mirrors the parts of the `queue.Queue` interface used by the connectors,
+    and counts every item it had to drop in `dropped`.
+
+    Args:
+        maxsize: Maximum number of queued items, 0 for unbounded.
+        policy: What to do when the queue is full.
+        is_mention: Predicate telling mentions apart from other items,
+                    required by `OverflowPolicy.DROP_NON_MENTIONS`.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 0,
+        policy: OverflowPolicy = OverflowPolicy.BLOCK,
+        is_mention: Optional[Callable[[T], bool]] = None,
+    ):
+        policy = OverflowPolicy(policy)
+        if policy is OverflowPolicy.DROP_NON_MENTIONS and is_mention is None:
+            raise ValueError("Policy 'drop-non-mentions' requires a mention predicate")
+
+        self._maxsize = maxsize
+        self._policy = policy
+        self._is_mention = is_mention
+        self._items: Deque[T] = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self.dropped = 0
+
+    def qsize(self) -> int:
+        """Number of currently queued items."""
+        with self._lock:
+            return len(self._items)
+
+    def put(self, item: T) -> None:
+        """Queue an item, applying the overflow policy if the queue is full."""
+        with self._not_full:
+            if self._maxsize > 0 and len(self._items) >= self._maxsize:
+                if self._policy is OverflowPolicy.BLOCK:
+                    while len(self._items) >= self._maxsize:
+                        self._not_full.wait()
+                elif not self._make_room(item):
+                    self._drop()
+                    return
+
+            self._items.append(item)
+            self._not_empty.notify()
+
+    def get(self, timeout: Optional[float] = None) -> T:
+        """Remove and return an item, waiting up to `timeout` seconds for one.
+
+        Raises:
+            queue.Empty: If no item became available in time.
+        """
+        with self._not_empty:
+            if timeout is None:
+                while not self._items:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._items:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def get_nowait(self) -> T:
+        """Remove and return an item if one is immediately available.
+
+        Raises:
+            queue.Empty: If the queue is empty.
+        """
+        with self._lock:
+            if not self._items:
+                raise queue.Empty
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def _make_room(self, item: T) -> bool:
+        # Returns False if the new item itself should be dropped instead
+        if self._policy is OverflowPolicy.DROP_NON_MENTIONS:
+            assert self._is_mention is not None
+            if not self._is_mention(item):
+                return False
+            for i, queued in enumerate(self._items):
+                if not self._is_mention(queued):
+                    del self._items[i]
+                    self._drop()
+                    return True
+
+        self._items.popleft()
+        self._drop()
+        return True
+
+    def _drop(self) -> None:
+        self.dropped += 1
+        log.debug("Queue full, dropped %d items so far", self.dropped)
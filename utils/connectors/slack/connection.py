@@ -0,0 +1,66 @@
+"""Websocket connection handling shared by the Slack source and sink."""
+from __future__ import annotations
+
+import logging
+import random
+import threading
+from typing import Optional
+
+import websockets.sync.client
+from websockets.sync.client import ClientConnection
+
+log = logging.getLogger(__name__)
+
+
+class Backoff:
+    """Exponential backoff with full jitter.
+
+    Every call to `next_delay` doubles the upper bound of the delay (up to
+    `maximum`) and returns a random delay below it, so that many workers
+    losing their connection at the same time don't reconnect in lockstep.
+    """
+
+    def __init__(
+        self, initial: float = 0.5, maximum: float = 30.0, factor: float = 2.0
+    ):
+        self._initial = initial
+        self._maximum = maximum
+        self._factor = factor
+        self._current = initial
+
+    def reset(self) -> None:
+        """Start over from the initial delay, called after a successful connect."""
+        self._current = self._initial
+
+    def next_delay(self) -> float:
+        """Get the next delay in seconds."""
+        delay = random.uniform(0, self._current)
+        self._current = min(self._current * self._factor, self._maximum)
+        return delay
+
+
+def connect(
+    url: str, backoff: Backoff, stop: threading.Event
+) -> Optional[ClientConnection]:
+    """Connect to the given url, retrying with backoff until connected or stopped.
+
+    Returns `None` if `stop` was set before a connection could be established.
+    """
+    while not stop.is_set():
+        try:
+            socket = websockets.sync.client.connect(url)
+        except Exception as e:
+            delay = backoff.next_delay()
+            log.error(
+                "Connection to %s failed (%s), reconnecting in %.2f seconds...",
+                url,
+                e,
+                delay,
+            )
+            stop.wait(delay)
+            continue
+
+        backoff.reset()
+        return socket
+
+    return None
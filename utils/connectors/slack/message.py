@@ -15,6 +15,9 @@ class SlackMessage:
     channel: The identifier of the slack channel. "Cxxxxxxxxxx"-style string.
     text: The textual contents of the message.
     timestamp: A UTC timestamp of the message.
+    partial: Whether this is an intermediate version of a reply that is still
+             being generated. The proxy posts the first version and edits it
+             in place as newer versions arrive.
     """
 
     id: str
@@ -22,6 +25,7 @@ class SlackMessage:
     channel: str
     text: str
     timestamp: datetime
+    partial: bool = False
 
     def __str__(self) -> str:
         """String-representation of the message, used by StdOutSink."""
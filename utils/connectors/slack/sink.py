@@ -1,70 +1,277 @@
 from __future__ import annotations
 
+import dataclasses
 import json
 import logging
 import queue
 import threading
-import time
+from typing import Optional
 
-import websockets
 from bytewax.outputs import DynamicSink
 from bytewax.outputs import StatelessSinkPartition
 
+from ... import wire
 from . import SlackMessage
+from .backpressure import BoundedQueue
+from .backpressure import OverflowPolicy
+from .connection import Backoff
+from .connection import connect
 
 log = logging.getLogger(__name__)
 
 
+def _encode(msg: SlackMessage) -> dict:
+    data = {"ts": msg.id, "text": msg.text, "channel": msg.channel}
+    if msg.partial:
+        data["partial"] = "1"
+    return data
+
+
+def _is_partial_greeting(message: Optional[bytes | str]) -> bool:
+    # Proxies that edit partial replies in place greet connections asking so
+    if not isinstance(message, str):
+        return False
+    try:
+        return json.loads(message).get("type") == "partial"
+    except (ValueError, AttributeError):
+        return False
+
+
 class _SlackSinkPartition(StatelessSinkPartition[SlackMessage]):
-    def __init__(self, queue: queue.Queue[SlackMessage], *args, **kwargs):
+    def __init__(
+        self,
+        url: str,
+        *args,
+        queue_size: int = 0,
+        overflow: OverflowPolicy = OverflowPolicy.BLOCK,
+        max_batch_size: int = 100,
+        coalesce: bool = False,
+        wire_format: str = "json",
+        partial: bool = False,
+        greeting_timeout: float = 5.0,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
-        self._queue = queue
+        self._url = url
+        self._partial = partial
+        self._greeting_timeout = greeting_timeout
+        # Whether the proxy confirmed it supports partial replies, `None` until
+        # it has been asked
+        self.supports_partial: Optional[bool] = None
+        self._wire_format = wire_format
+        self._queue: BoundedQueue[SlackMessage] = BoundedQueue(queue_size, overflow)
+        self._max_batch_size = max_batch_size
+        self._coalesce = coalesce
+
+        # Each partition owns its connection and sender thread. Once stopped,
+        # the sender exits when the queue is empty, or gives up when aborted.
+        self._stop = threading.Event()
+        self._abort = threading.Event()
+        self._thread = threading.Thread(target=self._send_messages, daemon=True)
+        self._thread.start()
+
+    @property
+    def dropped(self) -> int:
+        return self._queue.dropped
 
     def write_batch(self, items: list[SlackMessage]) -> None:
         for item in items:
             self._queue.put(item)
 
+    def _next_batch(self) -> list[SlackMessage]:
+        # Block for the first message so replies go out as soon as they arrive,
+        # but time out regularly to notice when the partition is closed.
+        try:
+            batch = [self._queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+
+        while len(batch) < self._max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _frames(self, batch: list[SlackMessage]) -> list[str | bytes]:
+        if not batch:
+            return []
+
+        if self._wire_format == "records":
+            records = [_encode(msg) for msg in batch]
+            if self._coalesce:
+                return [wire.encode_records(records, wire.SINK_FIELDS)]
+            return [wire.encode_record(record, wire.SINK_FIELDS) for record in records]
+
+        if self._coalesce and len(batch) > 1:
+            return [json.dumps([_encode(msg) for msg in batch])]
+        return [json.dumps(_encode(msg)) for msg in batch]
+
+    def _send_messages(self):
+        backoff = Backoff()
+        frames: list[str | bytes] = []
+        while True:
+            socket = connect(self._url, backoff, self._abort)
+            if socket is None:
+                return
+
+            with socket:
+                if self._partial:
+                    try:
+                        greeting = socket.recv(timeout=self._greeting_timeout)
+                    except TimeoutError:
+                        greeting = None
+                    except Exception as e:
+                        log.exception(e)
+                        log.error("Receive failed, reconnecting...")
+                        continue
+
+                    # Older proxies would post every partial reply as a new
+                    # message, so nothing is sent to them
+                    self.supports_partial = _is_partial_greeting(greeting)
+                    if not self.supports_partial:
+                        log.warning("Proxy doesn't support partial replies")
+                        return
+
+                while True:
+                    if not frames:
+                        if self._stop.is_set() and self._queue.qsize() == 0:
+                            return
+                        frames = self._frames(self._next_batch())
+                        continue
 
-# TODO: Move thread to partition
+                    try:
+                        socket.send(frames[0])
+                    except Exception as e:
+                        log.exception(e)
+                        log.error("Send failed, reconnecting...")
+                        break
+                    frames.pop(0)
+
+    def close(self) -> None:
+        # Give the sender a moment to flush the replies still in the queue
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._abort.set()
 
 
 class SlackSink(DynamicSink[SlackMessage]):
-    """Bytewax -compatible Slack-sink."""
+    """Bytewax -compatible Slack-sink.
 
-    def __init__(self, url: str):
-        self._url = f"{url}/sink"
+    Every partition sends its replies over its own connection to the proxy
+    from a background thread, which wakes up as soon as a reply is written.
 
-        self._thread = threading.Thread(target=self._send_messages, daemon=True)
+    Args:
+        url: Base url of the websocket proxy.
+        queue_size: Maximum number of replies waiting to be sent per partition,
+                    0 for unbounded.
+        overflow: What to do when the queue is full, either `OverflowPolicy.BLOCK`
+                  (stall the dataflow) or `OverflowPolicy.DROP_OLDEST`.
+        max_batch_size: Maximum number of queued replies sent in one go.
+        coalesce: Send a batch of replies as a single frame instead of one
+                  frame per reply.
+        wire_format: "json" for JSON frames, "records" for the compact binary
+                     framing of `utils.wire`.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        queue_size: int = 0,
+        overflow: OverflowPolicy = OverflowPolicy.BLOCK,
+        max_batch_size: int = 100,
+        coalesce: bool = False,
+        wire_format: str = "json",
+    ):
+        if wire_format not in ("json", "records"):
+            raise ValueError(f"Unknown wire format: {wire_format!r}")
+
+        self._url = f"{url}/sink?format={wire_format}"
+        self._wire_format = wire_format
+        self._queue_size = queue_size
+        self._overflow = overflow
+        self._max_batch_size = max_batch_size
+        self._coalesce = coalesce
+
+        # Partitions built in this process, for the drop counters
+        self._partitions: list[_SlackSinkPartition] = []
+
+    @property
+    def dropped(self) -> int:
+        """Number of replies dropped by the partitions of this process."""
+        return sum(partition.dropped for partition in self._partitions)
+
+    def build(self, worker_index: int, worker_count: int) -> _SlackSinkPartition:
+        partition = _SlackSinkPartition(
+            url=self._url,
+            queue_size=self._queue_size,
+            overflow=self._overflow,
+            max_batch_size=self._max_batch_size,
+            coalesce=self._coalesce,
+            wire_format=self._wire_format,
+        )
+        self._partitions.append(partition)
+        return partition
+
+
+class SlackUpdates:
+    """Sends intermediate versions of replies that are still being generated.
+
+    Used next to a `SlackSink`, for updates that should reach Slack before the
+    dataflow emits the final reply. Messages are sent over a connection of its
+    own, opened on the first update. When updates arrive faster than they can be
+    sent, the oldest ones are dropped, as only the latest version of a reply
+    matters. An update may thus reach the proxy after the final reply, which
+    the proxy then ignores.
+
+    Updates are only sent once the proxy confirms that it edits partial replies
+    in place. If it doesn't greet the connection within `greeting_timeout`
+    seconds, all updates are dropped and only the final replies reach Slack.
+
+    Args:
+        url: Base url of the websocket proxy.
+        wire_format: "json" for JSON frames, "records" for the compact binary
+                     framing of `utils.wire`.
+        queue_size: Maximum number of updates waiting to be sent.
+        greeting_timeout: Seconds to wait for the proxy to confirm it supports
+                          partial replies.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        wire_format: str = "json",
+        queue_size: int = 100,
+        greeting_timeout: float = 5.0,
+    ):
+        self._url = f"{url}/sink?format={wire_format}&partial=1"
+        self._wire_format = wire_format
+        self._queue_size = queue_size
+        self._greeting_timeout = greeting_timeout
         self._lock = threading.Lock()
-        self._thread.start()
-        self._queue: queue.Queue[SlackMessage] = queue.Queue()
+        self._partition: Optional[_SlackSinkPartition] = None
 
-    def _send_messages(self):
-        while True:
-            try:
-                socket = websockets.sync.client.connect(self._url)
-            except Exception as e:
-                log.exception(e)
-                log.error("Connection failed, reconnecting in 1 seconds...")
-                time.sleep(1)
-
-            while True:
-                try:
-                    msg = self._queue.get_nowait()
-                except queue.Empty:
-                    time.sleep(1)
-                    continue
-
-                msg_str = json.dumps(
-                    {"ts": msg.id, "text": msg.text, "channel": msg.channel}
+    def send(self, msg: SlackMessage) -> None:
+        """Queue a partial reply for sending."""
+        with self._lock:
+            if self._partition is None:
+                self._partition = _SlackSinkPartition(
+                    url=self._url,
+                    queue_size=self._queue_size,
+                    overflow=OverflowPolicy.DROP_OLDEST,
+                    wire_format=self._wire_format,
+                    partial=True,
+                    greeting_timeout=self._greeting_timeout,
                 )
+            partition = self._partition
 
-                try:
-                    socket.send(msg_str)
-                except Exception as e:
-                    log.exception(e)
-                    log.error("Send failed, reconnecting...")
-                    break
+        if partition.supports_partial is False:
+            return
+        partition.write_batch([dataclasses.replace(msg, partial=True)])
 
-    def build(self, worker_index: int, worker_count: int) -> _SlackSinkPartition:
-        return _SlackSinkPartition(queue=self._queue)
+    def close(self) -> None:
+        """Flush the queued updates and close the connection."""
+        with self._lock:
+            partition, self._partition = self._partition, None
+        if partition is not None:
+            partition.close()
@@ -3,41 +3,174 @@ from __future__ import annotations
 import json
 import logging
 import queue
-import random
 import threading
-import time
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
+from typing import Callable
 from typing import Iterable
 from typing import Optional
+from urllib.parse import urlencode
 
-import websockets.sync.client
 from bytewax.inputs import DynamicSource
 from bytewax.inputs import StatelessSourcePartition
 
+from ... import wire
 from . import SlackMessage
+from .backpressure import BoundedQueue
+from .backpressure import OverflowPolicy
+from .connection import Backoff
+from .connection import connect
 
 log = logging.getLogger(__name__)
 
 
+def _is_subscribed(message: bytes | str) -> bool:
+    # Subscribing proxies greet with a text frame, events are binary frames
+    if not isinstance(message, str):
+        return False
+    try:
+        return json.loads(message).get("type") == "subscribed"
+    except (ValueError, AttributeError):
+        return False
+
+
+def _contains(mention: str) -> Callable[[bytes | str], bool]:
+    mention_bytes = mention.encode("utf-8")
+
+    def _func(data: bytes | str) -> bool:
+        if isinstance(data, str):
+            return mention in data
+        return mention_bytes in data
+
+    return _func
+
+
 class _SlackSourcePartition(StatelessSourcePartition[SlackMessage]):
-    def __init__(self, queue: queue.Queue, *args, max_batch_size: int = 10, **kwargs):
+    def __init__(
+        self,
+        url: str,
+        *args,
+        max_batch_size: int = 100,
+        max_batch_bytes: int = 1024 * 1024,
+        min_backoff: timedelta = timedelta(milliseconds=1),
+        max_backoff: timedelta = timedelta(milliseconds=100),
+        queue_size: int = 0,
+        overflow: OverflowPolicy = OverflowPolicy.BLOCK,
+        mention: Optional[str] = None,
+        wire_format: str = "json",
+        worker_index: int = 0,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
-        self._queue = queue
+        self._url = url
+        self._wire_format = wire_format
+        self._worker_index = worker_index
+        # Set when connected to a proxy that ignores the subscription
+        self._legacy = False
+        self._queue: BoundedQueue[bytes] = BoundedQueue(
+            queue_size,
+            overflow,
+            is_mention=_contains(mention) if mention is not None else None,
+        )
         self._max_batch_size = max_batch_size
+        self._max_batch_bytes = max_batch_bytes
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+
+        # Backoff to apply after the latest batch, `None` to wake immediately
+        self._backoff: Optional[timedelta] = None
+
+        # Each partition owns its connection, so a dead connection only stalls
+        # the partition it belongs to.
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._receive_messages, daemon=True)
+        self._thread.start()
+
+    def _receive_messages(self):
+        backoff = Backoff()
+        while not self._stop.is_set():
+            socket = connect(self._url, backoff, self._stop)
+            if socket is None:
+                return
+
+            with socket:
+                subscribed: Optional[bool] = None
+                while not self._stop.is_set():
+                    try:
+                        # Time out regularly to notice when the partition is closed
+                        message = socket.recv(timeout=1)
+                    except TimeoutError:
+                        continue
+                    except Exception as e:
+                        log.exception(e)
+                        log.error("Receive failed, reconnecting...")
+                        break
+
+                    if subscribed is None:
+                        subscribed = _is_subscribed(message)
+                        if subscribed:
+                            self._legacy = False
+                            continue
+                        if not self._use_legacy_proxy():
+                            return
+
+                    self._queue.put(message)
+
+    def _use_legacy_proxy(self) -> bool:
+        # Older proxies send every event to every connection in the JSON format,
+        # so only the first worker keeps its connection, like a single
+        # connection per process did.
+        self._legacy = True
+        if self._worker_index != 0:
+            log.warning(
+                "Proxy ignores worker subscriptions, worker %d stops receiving",
+                self._worker_index,
+            )
+            self._stop.set()
+            return False
+
+        log.warning("Proxy ignores subscriptions, receiving all events as JSON")
+        return True
+
+    @property
+    def dropped(self) -> int:
+        return self._queue.dropped
 
     def next_batch(self, sched: datetime) -> Iterable[SlackMessage]:
         batch = []
-        for _ in range(self._max_batch_size):
+        batch_bytes = 0
+        while len(batch) < self._max_batch_size and batch_bytes < self._max_batch_bytes:
             try:
-                batch.append(self._build_message(self._queue.get_nowait()))
+                data = self._queue.get_nowait()
             except queue.Empty:
                 break
+            batch.extend(self._build_messages(data))
+            batch_bytes += len(data)
+
+        if batch:
+            self._backoff = None
+        elif self._backoff is None:
+            self._backoff = self._min_backoff
+        else:
+            self._backoff = min(self._backoff * 2, self._max_backoff)
+
         return batch
 
-    def _build_message(self, data: bytes) -> SlackMessage:
-        msg = json.loads(data)
+    def _build_messages(self, data: bytes) -> list[SlackMessage]:
+        if self._wire_format == "records" and not self._legacy:
+            return [
+                self._build_message(msg)
+                for msg in wire.decode_records(data, wire.SOURCE_FIELDS)
+            ]
+
+        # Coalesced frames carry a JSON array of events
+        payload = json.loads(data)
+        if isinstance(payload, list):
+            return [self._build_message(msg) for msg in payload]
+        return [self._build_message(payload)]
+
+    def _build_message(self, msg: dict) -> SlackMessage:
         return SlackMessage(
             channel=msg["channel"],
             id=msg["ts"],
@@ -47,44 +180,104 @@ class _SlackSourcePartition(StatelessSourcePartition[SlackMessage]):
         )
 
     def next_awake(self) -> Optional[datetime]:
-        # Reduce polling rate
-        return datetime.now(timezone.utc) + timedelta(milliseconds=100)
+        # Keep draining while there is data, back off exponentially when idle
+        if self._backoff is None:
+            return None
+        return datetime.now(timezone.utc) + self._backoff
+
+    def close(self) -> None:
+        self._stop.set()
 
 
 class SlackSource(DynamicSource[SlackMessage]):
-    """Bytewax-compatible Slack source."""
+    """Bytewax-compatible Slack source.
+
+    Every partition opens its own connection to the proxy and tells it which
+    worker it is, so that the proxy can deliver each message to exactly one
+    worker. Connections are re-established with exponential backoff and jitter.
+    Older proxies, which send every message to every connection, are detected
+    by their missing greeting; then only the first worker receives messages,
+    as plain JSON.
+
+    Partitions keep draining their queue as long as messages are available
+    and only back off (exponentially, between `min_backoff` and `max_backoff`)
+    once the queue has been found empty.
 
-    def __init__(self, url: str, *args, **kwargs):
+    Args:
+        url: Base url of the websocket proxy.
+        max_batch_size: Maximum number of messages emitted per batch.
+        max_batch_bytes: Maximum size of the raw frames emitted per batch.
+        min_backoff: Delay before polling again after the first empty batch.
+        max_backoff: Upper limit for the delay between polls of an idle queue.
+        routing: How the proxy assigns messages to workers. "random" spreads
+                 them evenly, "channel" sends all messages of a channel to the
+                 worker that bytewax keeps the channel's keyed state on, so
+                 steps keyed by channel id don't exchange them between workers.
+        queue_size: Maximum number of received messages buffered per partition,
+                    0 for unbounded.
+        overflow: What to do when the buffer is full. `OverflowPolicy.BLOCK`
+                  stops reading from the proxy, letting its queue fill up.
+        mention: The mention tag (e.g. "<@Uxxx>") telling mentions apart, needed
+                 by `OverflowPolicy.DROP_NON_MENTIONS`.
+        coalesce: Ask the proxy to send pending events as JSON array frames of
+                  up to `max_batch_size` events. With a bounded queue, a frame
+                  is kept or dropped as a whole.
+        channels: Only receive messages from these channel ids. The proxy
+                  filters them, so other traffic never reaches the dataflow.
+        mentions_only: Only receive messages containing `mention`.
+        wire_format: "json" for JSON frames, "records" for the compact binary
+                     framing of `utils.wire`, which is cheaper to decode.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        *args,
+        max_batch_size: int = 100,
+        max_batch_bytes: int = 1024 * 1024,
+        min_backoff: timedelta = timedelta(milliseconds=1),
+        max_backoff: timedelta = timedelta(milliseconds=100),
+        routing: str = "random",
+        queue_size: int = 0,
+        overflow: OverflowPolicy = OverflowPolicy.BLOCK,
+        mention: Optional[str] = None,
+        coalesce: bool = False,
+        channels: Optional[Iterable[str]] = None,
+        mentions_only: bool = False,
+        wire_format: str = "json",
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
+        if routing not in ("random", "channel"):
+            raise ValueError(f"Unknown routing mode: {routing!r}")
+        if wire_format not in ("json", "records"):
+            raise ValueError(f"Unknown wire format: {wire_format!r}")
+
         self._url = f"{url}/source"
+        self._routing = routing
+        self._max_batch_size = max_batch_size
+        self._max_batch_bytes = max_batch_bytes
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._queue_size = queue_size
+        self._overflow = OverflowPolicy(overflow)
+        self._mention = mention
+        self._coalesce = coalesce
+        self._channels = sorted(channels) if channels is not None else None
+        self._mentions_only = mentions_only
+        self._wire_format = wire_format
+        if self._overflow is OverflowPolicy.DROP_NON_MENTIONS and mention is None:
+            raise ValueError("Policy 'drop-non-mentions' requires a mention")
+        if mentions_only and mention is None:
+            raise ValueError("mentions_only requires a mention")
 
-        # One queue for each worker
-        self._queues: list[queue.Queue[bytes]] = []
+        # Partitions built in this process, for the drop counters
+        self._partitions: list[_SlackSourcePartition] = []
 
-        self._thread = threading.Thread(target=self._receive_messages, daemon=True)
-        self._lock = threading.Lock()
-        self._thread.start()
-
-    def _receive_messages(self):
-        while True:
-            try:
-                socket = websockets.sync.client.connect(self._url)
-            except Exception as e:
-                log.exception(e)
-                log.error("Connection failed, reconnecting in 1 second...")
-                time.sleep(1)
-
-            while True:
-                try:
-                    message = socket.recv()
-                except Exception as e:
-                    log.exception(e)
-                    log.error("Receive failed, reconnecting...")
-                    break
-
-                # distribute to a worker
-                with self._lock:
-                    self._queues[random.randint(0, len(self._queues) - 1)].put(message)
+    @property
+    def dropped(self) -> int:
+        """Number of messages dropped by the partitions of this process."""
+        return sum(partition.dropped for partition in self._partitions)
 
     def build(
         self,
@@ -92,8 +285,32 @@ class SlackSource(DynamicSource[SlackMessage]):
         worker_index: int,
         worker_count: int,
     ) -> _SlackSourcePartition:
-        q: queue.Queue[bytes] = queue.Queue()
-        with self._lock:
-            self._queues.append(q)
-
-        return _SlackSourcePartition(queue=q)
+        query = {
+            "worker_index": worker_index,
+            "worker_count": worker_count,
+            "routing": self._routing,
+            "batch": self._max_batch_size if self._coalesce else 1,
+            # Only the fields used by `_build_message`
+            "schema": "compact",
+            "format": self._wire_format,
+        }
+        if self._channels is not None:
+            query["channels"] = ",".join(self._channels)
+        if self._mentions_only:
+            query["mentions_only"] = 1
+            query["mention"] = self._mention
+        params = urlencode(query)
+        partition = _SlackSourcePartition(
+            url=f"{self._url}?{params}",
+            max_batch_size=self._max_batch_size,
+            max_batch_bytes=self._max_batch_bytes,
+            min_backoff=self._min_backoff,
+            max_backoff=self._max_backoff,
+            queue_size=self._queue_size,
+            overflow=self._overflow,
+            mention=self._mention,
+            wire_format=self._wire_format,
+            worker_index=worker_index,
+        )
+        self._partitions.append(partition)
+        return partition
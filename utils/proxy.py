@@ -2,27 +2,572 @@
 from __future__ import annotations
 
 import asyncio
+import collections
+import dataclasses
+import functools
+import hashlib
+import heapq
 import json
 import logging
 import os
+import time
 from contextlib import asynccontextmanager
 from typing import Any
+from typing import Deque
+from typing import Mapping
+from typing import Optional
 
 import dotenv
 import fastapi
 import uvicorn
 from slack_bolt.adapter.socket_mode.aiohttp import AsyncSocketModeHandler
 from slack_bolt.async_app import AsyncApp
-from slack_bolt.async_app import AsyncSay
+from slack_sdk.errors import SlackApiError
 from starlette.datastructures import Address
 from starlette.websockets import WebSocketDisconnect
 
+from utils import wire
+
 log = logging.getLogger(__name__)
 
+_MASK = (1 << 64) - 1
+
+
+def _rotate(x: int, bits: int) -> int:
+    return ((x << bits) | (x >> (64 - bits))) & _MASK
+
+
+def _siphash13(data: bytes) -> int:
+    # SipHash-1-3 with zero keys, the hash of Rust's `DefaultHasher`
+    v0 = 0x736F6D6570736575
+    v1 = 0x646F72616E646F6D
+    v2 = 0x6C7967656E657261
+    v3 = 0x7465646279746573
+
+    def _round():
+        nonlocal v0, v1, v2, v3
+        v0 = (v0 + v1) & _MASK
+        v1 = _rotate(v1, 13) ^ v0
+        v0 = _rotate(v0, 32)
+        v2 = (v2 + v3) & _MASK
+        v3 = _rotate(v3, 16) ^ v2
+        v0 = (v0 + v3) & _MASK
+        v3 = _rotate(v3, 21) ^ v0
+        v2 = (v2 + v1) & _MASK
+        v1 = _rotate(v1, 17) ^ v2
+        v2 = _rotate(v2, 32)
+
+    end = len(data) - len(data) % 8
+    for i in range(0, end, 8):
+        m = int.from_bytes(data[i : i + 8], "little")
+        v3 ^= m
+        _round()
+        v0 ^= m
+
+    m = ((len(data) & 0xFF) << 56) | int.from_bytes(data[end:], "little")
+    v3 ^= m
+    _round()
+    v0 ^= m
+    v2 ^= 0xFF
+    for _ in range(3):
+        _round()
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+@functools.lru_cache(maxsize=4096)
+def keyed_worker(key: str, worker_count: int) -> int:
+    """Get the worker bytewax routes the state of `key` to.
+
+    Bytewax hashes keys with Rust's default hasher, which hashes a string as
+    its bytes followed by 0xff.
+    """
+    return _siphash13(key.encode("utf-8") + b"\xff") % worker_count
+
+
+@dataclasses.dataclass
+class Subscription:
+    """Which events a connected source worker receives.
+
+    Every worker of a dataflow connects with its own index and the total
+    worker count, and each event is delivered to exactly one of them. Events
+    the worker is not interested in are dropped here, before they are encoded
+    and sent.
+
+    worker_index: Index of the connected worker.
+    worker_count: Total number of workers in the dataflow.
+    routing: "channel" to send all events of a channel to the worker that
+             bytewax routes the channel's keyed state to (see `keyed_worker`),
+             "random" to spread events evenly over the workers.
+    channels: Channel ids to receive events from, `None` for all channels.
+    mention: Only receive events containing this mention tag, if set.
+    schema: "full" to receive the whole Slack event, "compact" to only receive
+            the fields the connectors use (see `COMPACT_FIELDS`).
+    format: "json" for JSON frames, "records" for the binary framing of
+            `utils.wire`, which always uses the compact fields.
+    """
+
+    worker_index: int = 0
+    worker_count: int = 1
+    routing: str = "random"
+    channels: Optional[frozenset[str]] = None
+    mention: Optional[str] = None
+    schema: str = "full"
+    format: str = "json"
+
+    @classmethod
+    def from_query_params(cls, params: Mapping[str, str]) -> Subscription:
+        """Parse the subscription a listener asked for when connecting.
+
+        `channels` is a comma separated list of channel ids. `mentions_only`
+        limits the events to ones mentioning the bot, either with the tag given
+        in `mention` or the one configured with BOT_MENTION.
+        """
+        channels = params.get("channels")
+        schema = params.get("schema", "full")
+        if schema not in ("full", "compact"):
+            raise ValueError(f"Unknown schema: {schema!r}")
+        format = params.get("format", "json")
+        if format not in ("json", "records"):
+            raise ValueError(f"Unknown format: {format!r}")
+
+        mention = None
+        if params.get("mentions_only", "").lower() in ("1", "true", "yes"):
+            mention = params.get("mention") or os.environ.get("BOT_MENTION")
+            if not mention:
+                raise ValueError("mentions_only requires a mention tag")
+
+        return cls(
+            worker_index=int(params.get("worker_index", 0)),
+            worker_count=int(params.get("worker_count", 1)),
+            routing=params.get("routing", "random"),
+            channels=frozenset(channels.split(",")) if channels else None,
+            mention=mention,
+            schema=schema,
+            format=format,
+        )
+
+    @property
+    def encoding(self) -> str:
+        """The `EncodedEvent` encoding this listener receives."""
+        return "records" if self.format == "records" else self.schema
+
+    def accepts(self, event: dict[str, Any]) -> bool:
+        """Check if the event belongs to this worker."""
+        if self.channels is not None and event.get("channel") not in self.channels:
+            return False
+
+        if self.mention is not None and self.mention not in event.get("text", ""):
+            return False
+
+        if self.worker_count <= 1:
+            return True
+
+        if self.routing == "channel":
+            # Steps keyed by channel then find the event on their own worker,
+            # and don't have to exchange it with another one
+            channel = event.get("channel", "")
+            return keyed_worker(channel, self.worker_count) == self.worker_index
+
+        key = event.get("ts", "")
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % self.worker_count == self.worker_index
+
+
+# The event fields needed to build a `SlackMessage`
+COMPACT_FIELDS = wire.SOURCE_FIELDS
+
+
+class EncodedEvent:
+    """A Slack event serialized at most once per encoding, shared by all listeners.
+
+    Encodings are "full" and "compact" JSON, and "records" for `utils.wire`.
+    """
+
+    def __init__(self, event: dict[str, Any]):
+        self._event = event
+        self._encoded: dict[str, bytes] = {}
+
+    def encode(self, encoding: str) -> bytes:
+        """Get the event as bytes in the given encoding."""
+        encoded = self._encoded.get(encoding)
+        if encoded is None:
+            if encoding == "records":
+                encoded = wire.encode_record(self._event, wire.SOURCE_FIELDS)
+            elif encoding == "compact":
+                data = {field: self._event.get(field) for field in COMPACT_FIELDS}
+                encoded = json.dumps(data).encode("utf-8")
+            else:
+                encoded = json.dumps(self._event).encode("utf-8")
+            self._encoded[encoding] = encoded
+        return encoded
+
+
+class ListenerQueue:
+    """A bounded queue of encoded events waiting to be sent to one listener.
+
+    When full, the `policy` decides what happens to new events:
+
+    "block": `put` waits until the listener has made room.
+    "drop-oldest": The oldest queued event is discarded.
+    "drop-non-mentions": Events not containing `mention` are discarded first,
+                         the oldest mention only if nothing else is left.
+
+    Discarded events are counted in `dropped`.
+    """
+
+    POLICIES = ("block", "drop-oldest", "drop-non-mentions")
+
+    def __init__(self, maxsize: int = 0, policy: str = "block", mention: str = ""):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy!r}")
+        if policy == "drop-non-mentions" and not mention:
+            raise ValueError("Policy 'drop-non-mentions' requires a mention")
+
+        self._maxsize = maxsize
+        self._policy = policy
+        self._mention = mention.encode("utf-8")
+        self._items: Deque[bytes] = collections.deque()
+        self._not_full = asyncio.Event()
+        self._not_empty = asyncio.Event()
+        self._closed = False
+        self.dropped = 0
+
+    def qsize(self) -> int:
+        """Number of currently queued events."""
+        return len(self._items)
+
+    def full(self) -> bool:
+        """Check if the queue has reached its size limit."""
+        return self._maxsize > 0 and len(self._items) >= self._maxsize
+
+    async def put(self, item: bytes) -> None:
+        """Queue an event, applying the overflow policy if the queue is full."""
+        if self.full():
+            if self._policy == "block":
+                while self.full() and not self._closed:
+                    self._not_full.clear()
+                    await self._not_full.wait()
+            elif not self._make_room(item):
+                self.dropped += 1
+                return
+
+        if not self._closed:
+            self._items.append(item)
+            self._not_empty.set()
+
+    async def get_batch(self, max_items: int) -> list[bytes]:
+        """Wait for events and remove up to `max_items` of them from the queue."""
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        count = min(max_items, len(self._items))
+        batch = [self._items.popleft() for _ in range(count)]
+        self._not_full.set()
+        return batch
+
+    def close(self) -> None:
+        """Release producers blocked on this queue, the listener is gone."""
+        self._closed = True
+        self._items.clear()
+        self._not_full.set()
+
+    def _make_room(self, item: bytes) -> bool:
+        # Returns False if the new item itself should be dropped instead
+        if self._policy == "drop-non-mentions":
+            if self._mention not in item:
+                return False
+            for i, queued in enumerate(self._items):
+                if self._mention not in queued:
+                    del self._items[i]
+                    self.dropped += 1
+                    return True
+
+        self._items.popleft()
+        self.dropped += 1
+        return True
+
+
+def _create_listener_queue() -> ListenerQueue:
+    return ListenerQueue(
+        maxsize=int(os.environ.get("SOURCE_QUEUE_SIZE", "1000")),
+        policy=os.environ.get("SOURCE_OVERFLOW_POLICY", "drop-oldest"),
+        mention=os.environ.get("BOT_MENTION", ""),
+    )
+
+
+class TokenBucket:
+    """A token bucket limiting the rate of messages sent to one channel.
+
+    rate: Tokens added per second.
+    burst: Maximum number of tokens the bucket holds.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available."""
+        self._refill(now)
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    def take(self, now: float) -> None:
+        """Consume a token, call only when `delay` returned 0."""
+        self._refill(now)
+        self._tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for a while, e.g. when Slack asks us to.
+
+        No tokens are added during the pause, so only a single message may be
+        sent right after it, and the rest at the normal rate.
+        """
+        self._paused_until = time.monotonic() + seconds
+        self._tokens = min(1.0, self._burst)
+        self._updated = self._paused_until
+
+    def _refill(self, now: float) -> None:
+        # `_updated` lies in the future while paused
+        if now <= self._updated:
+            return
+        refilled = self._tokens + (now - self._updated) * self._rate
+        self._tokens = min(self._burst, refilled)
+        self._updated = now
+
+
+@dataclasses.dataclass(order=True)
+class OutboundMessage:
+    """A reply waiting to be posted to Slack.
+
+    Lower `priority` values are sent first, `seq` keeps the submission order
+    among messages of equal priority. A `partial` message is an intermediate
+    version of a reply that is still being generated.
+    """
+
+    priority: int
+    seq: int
+    channel: str = dataclasses.field(compare=False)
+    thread_ts: str = dataclasses.field(compare=False)
+    text: str = dataclasses.field(compare=False)
+    partial: bool = dataclasses.field(default=False, compare=False)
+    attempts: int = dataclasses.field(default=0, compare=False)
+
+
+class OutboundScheduler:
+    """Posts replies to Slack while staying within its rate limits.
+
+    Replies are kept in a priority queue and sent as soon as the per-channel
+    token bucket allows. Consecutive replies to the same thread that are still
+    waiting are merged into a single message, and a 429 response pauses the
+    channel for the time given in its Retry-After header before retrying.
+    Each channel has at most one request in flight, so replies to a channel
+    are posted in order.
+
+    Partial replies are posted once and then edited in place with
+    `chat.update` as newer versions arrive, until the final reply replaces
+    them. Only the latest queued version of a partial reply is sent. Partial
+    and final replies may reach the proxy over different connections, so a
+    partial reply arriving after the final reply of its thread is dropped,
+    instead of being posted as a new message that is never finished.
+
+    Args:
+        rate: Messages per second allowed for each channel.
+        burst: Number of messages a channel may send back-to-back.
+        max_attempts: How many times a failing message is tried before dropped.
+        max_finished: Number of most recently finished threads remembered for
+                      dropping late partial replies.
+    """
+
+    def __init__(
+        self,
+        rate: float = 1.0,
+        burst: int = 3,
+        max_attempts: int = 5,
+        max_finished: int = 10_000,
+    ):
+        self._rate = rate
+        self._burst = burst
+        self._max_attempts = max_attempts
+        self._max_finished = max_finished
+        self._heap: list[OutboundMessage] = []
+        self._buckets: dict[str, TokenBucket] = {}
+        self._in_flight: set[str] = set()
+        # The event loop only keeps weak references to the tasks of sends
+        self._tasks: set[asyncio.Future] = set()
+        # (channel, thread_ts) -> ts of the posted message of a partial reply
+        self._streams: dict[tuple[str, str], str] = {}
+        # (channel, thread_ts) of the threads that got their final reply
+        self._finished: collections.OrderedDict[tuple[str, str], None] = (
+            collections.OrderedDict()
+        )
+        self._wakeup = asyncio.Event()
+        self._seq = 0
+        self.sent = 0
+        self.merged = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self.stale = 0
+
+    def qsize(self) -> int:
+        """Number of replies waiting to be sent."""
+        return len(self._heap)
+
+    def submit(
+        self,
+        channel: str,
+        thread_ts: str,
+        text: str,
+        priority: int = 0,
+        partial: bool = False,
+    ):
+        """Queue a reply for sending."""
+        stream = (channel, thread_ts)
+        if partial and stream in self._finished:
+            self.stale += 1
+            log.debug("Dropping partial reply to finished thread %s", stream)
+            return
+        if not partial:
+            self._finished[stream] = None
+            if len(self._finished) > self._max_finished:
+                self._finished.popitem(last=False)
+
+        self._seq += 1
+        heapq.heappush(
+            self._heap,
+            OutboundMessage(priority, self._seq, channel, thread_ts, text, partial),
+        )
+        self._wakeup.set()
+
+    async def run(self, client) -> None:
+        """Send queued replies forever using the given Slack web client."""
+        while True:
+            self._wakeup.clear()
+            msg, delay = self._next_ready(time.monotonic())
+            if msg is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._in_flight.add(msg.channel)
+            task = asyncio.ensure_future(self._send(client, msg))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _bucket(self, channel: str) -> TokenBucket:
+        if channel not in self._buckets:
+            self._buckets[channel] = TokenBucket(self._rate, self._burst)
+        return self._buckets[channel]
+
+    def _next_ready(
+        self, now: float
+    ) -> tuple[Optional[OutboundMessage], Optional[float]]:
+        # Find the most urgent message whose channel may send right now. If there
+        # is none, return how long to wait for the earliest channel to free up.
+        min_delay = None
+        skipped = set()
+        for msg in sorted(self._heap):
+            if msg.channel in self._in_flight or msg.channel in skipped:
+                continue
+
+            bucket = self._bucket(msg.channel)
+            delay = bucket.delay(now)
+            if delay > 0:
+                skipped.add(msg.channel)
+                min_delay = delay if min_delay is None else min(min_delay, delay)
+                continue
+
+            bucket.take(now)
+            self._heap.remove(msg)
+            self._merge_into(msg)
+            heapq.heapify(self._heap)
+            return msg, None
+
+        return None, min_delay
+
+    def _merge_into(self, msg: OutboundMessage) -> None:
+        same_thread = sorted(
+            other
+            for other in self._heap
+            if other.channel == msg.channel and other.thread_ts == msg.thread_ts
+        )
+        if not same_thread:
+            return
+
+        for other in same_thread:
+            self._heap.remove(other)
+            self.merged += 1
+
+        # Final replies are joined together and supersede any partial ones,
+        # otherwise only the most recent partial reply is worth sending.
+        group = sorted([msg, *same_thread], key=lambda m: m.seq)
+        finals = [m.text for m in group if not m.partial]
+        if finals:
+            msg.text = "\n\n".join(finals)
+            msg.partial = False
+        else:
+            msg.text = group[-1].text
+
+    async def _send(self, client, msg: OutboundMessage) -> None:
+        stream = (msg.channel, msg.thread_ts)
+        try:
+            posted_ts = self._streams.get(stream)
+            if posted_ts is None:
+                response = await client.chat_postMessage(
+                    channel=msg.channel,
+                    text=msg.text,
+                    thread_ts=msg.thread_ts,
+                    username="Bytewax",
+                )
+                if msg.partial:
+                    self._streams[stream] = response["ts"]
+            else:
+                await client.chat_update(
+                    channel=msg.channel, ts=posted_ts, text=msg.text
+                )
+                if not msg.partial:
+                    del self._streams[stream]
+            self.sent += 1
+        except Exception as e:
+            # Connection errors are retried just like errors reported by Slack
+            msg.attempts += 1
+            if isinstance(e, SlackApiError) and e.response.status_code == 429:
+                self.rate_limited += 1
+                retry_after = float(e.response.headers.get("Retry-After", 1))
+                log.warning(
+                    "Rate limited on channel %s, retrying in %s seconds",
+                    msg.channel,
+                    retry_after,
+                )
+                self._bucket(msg.channel).pause(retry_after)
+            else:
+                log.exception(e)
+
+            if msg.attempts < self._max_attempts:
+                heapq.heappush(self._heap, msg)
+            else:
+                self.failed += 1
+                log.error("Giving up on reply to %s: %s", msg.channel, msg.text)
+        finally:
+            self._in_flight.discard(msg.channel)
+            self._wakeup.set()
+
+
+# Events dropped by listeners that have since disconnected
+DROPPED_EVENTS = 0
 
 # This won't work with many workers, but we are limiting ours to just 1
-SOURCE_QUEUES: dict[Address, asyncio.Queue] = {}
-SINK_QUEUE: asyncio.Queue = asyncio.Queue()
+SOURCE_QUEUES: dict[Address, ListenerQueue] = {}
+SUBSCRIPTIONS: dict[Address, Subscription] = {}
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -34,6 +579,11 @@ dotenv.load_dotenv()
 
 slack_app = None
 
+OUTBOUND = OutboundScheduler(
+    rate=float(os.environ.get("SLACK_CHANNEL_RATE", "1.0")),
+    burst=int(os.environ.get("SLACK_CHANNEL_BURST", "3")),
+)
+
 
 @asynccontextmanager
 async def slack_connector(app: fastapi.FastAPI):
@@ -59,6 +609,7 @@ async def slack_connector(app: fastapi.FastAPI):
             slack_app, os.environ.get("SLACK_APP_TOKEN")
         ).start_async()
     )
+    loop.create_task(OUTBOUND.run(slack_app.client))
 
     yield
 
@@ -68,46 +619,133 @@ fastapi_app = fastapi.FastAPI(lifespan=slack_connector)
 
 @fastapi_app.websocket("/source")
 async def source_handler(websocket: fastapi.WebSocket):
+    global DROPPED_EVENTS
     await websocket.accept()
 
     assert websocket.client is not None
 
-    SOURCE_QUEUES[websocket.client] = asyncio.Queue()
+    params = websocket.query_params
     try:
+        subscription = Subscription.from_query_params(params)
+    except ValueError as e:
+        log.error("Rejecting listener %s: %s", websocket.client, e)
+        await websocket.close(code=1008, reason=str(e))
+        return
+
+    SUBSCRIPTIONS[websocket.client] = subscription
+    # Listeners that understand JSON array frames may ask for pending events to
+    # be coalesced, up to `batch` events per frame.
+    max_batch = max(1, int(params.get("batch", 1)))
+
+    queue = _create_listener_queue()
+    SOURCE_QUEUES[websocket.client] = queue
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(websocket))
+    try:
+        # Tell listeners that say which worker they are that their subscription
+        # is honoured, so that they can tell this proxy apart from older ones,
+        # which send every event to everyone. Other listeners only expect events.
+        if "worker_index" in params:
+            await websocket.send_text(json.dumps({"type": "subscribed"}))
+
         while True:
-            try:
-                msg = SOURCE_QUEUES[websocket.client].get_nowait()
-            except asyncio.queues.QueueEmpty:
-                await asyncio.sleep(0.3)
-                continue
+            next_batch = asyncio.ensure_future(queue.get_batch(max_batch))
+            await asyncio.wait(
+                {next_batch, disconnected}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if disconnected.done():
+                next_batch.cancel()
+                break
+
+            batch = next_batch.result()
+            if subscription.format == "records":
+                frame = b"".join(batch)
+            elif max_batch > 1:
+                frame = b"[" + b",".join(batch) + b"]"
+            else:
+                (frame,) = batch
 
             try:
-                log.info("Received message: %s", msg)
-                await websocket.send_bytes(msg.encode("utf-8"))
+                log.debug("Forwarding %d messages to %s", len(batch), websocket.client)
+                await websocket.send_bytes(frame)
             except WebSocketDisconnect:
                 break
     finally:
+        disconnected.cancel()
         SOURCE_QUEUES.pop(websocket.client)
+        SUBSCRIPTIONS.pop(websocket.client)
+        DROPPED_EVENTS += queue.dropped
+        queue.close()
+
+
+async def _wait_for_disconnect(websocket: fastapi.WebSocket) -> None:
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+
+@fastapi_app.get("/stats")
+async def stats_handler() -> dict[str, Any]:
+    """Queue sizes and drop counters of the connected source listeners."""
+    listeners = {
+        f"{client.host}:{client.port}": {
+            "queued": queue.qsize(),
+            "dropped": queue.dropped,
+        }
+        for client, queue in SOURCE_QUEUES.items()
+    }
+    return {
+        "dropped": DROPPED_EVENTS + sum(q.dropped for q in SOURCE_QUEUES.values()),
+        "listeners": listeners,
+        "outbound": {
+            "queued": OUTBOUND.qsize(),
+            "sent": OUTBOUND.sent,
+            "merged": OUTBOUND.merged,
+            "rate_limited": OUTBOUND.rate_limited,
+            "failed": OUTBOUND.failed,
+            "stale": OUTBOUND.stale,
+        },
+    }
 
 
 @fastapi_app.websocket("/sink")
 async def sink_handler(websocket: fastapi.WebSocket):
     await websocket.accept()
 
-    while True:
-        try:
-            msg_bytes = await websocket.receive_text()
-        except WebSocketDisconnect:
-            return
+    format = websocket.query_params.get("format", "json")
 
-        msg = json.loads(msg_bytes)
-        log.info("Sending message: %s", msg)
+    # Tell connectors that ask that partial replies are edited in place, so that
+    # they can tell this proxy apart from older ones, which would post every
+    # partial reply as a new message.
+    if "partial" in websocket.query_params:
+        await websocket.send_text(json.dumps({"type": "partial"}))
 
-        reply = msg["text"]
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
 
-        if slack_app is not None:
-            say = AsyncSay(slack_app.client, msg["channel"])
-            await say(reply, username="Bytewax", thread_ts=msg["ts"])
+        # Connectors may coalesce several replies into a single frame
+        if format == "records":
+            msgs = list(wire.decode_records(message["bytes"], wire.SINK_FIELDS))
+        else:
+            data = message.get("text") or message.get("bytes")
+            payload = json.loads(data)
+            msgs = payload if isinstance(payload, list) else [payload]
+
+        # Replies are posted by the outbound scheduler, so a burst of replies
+        # doesn't hold up reading from the websocket.
+        for msg in msgs:
+            log.info("Queueing message: %s", msg)
+            # Intermediate versions of a reply are less urgent than whole replies
+            partial = bool(msg.get("partial"))
+            OUTBOUND.submit(
+                msg["channel"],
+                msg["ts"],
+                msg["text"],
+                priority=msg.get("priority", 1 if partial else 0),
+                partial=partial,
+            )
 
 
 async def distribute_message_to_listeners(body: dict[str, Any], say):
@@ -115,13 +753,19 @@ async def distribute_message_to_listeners(body: dict[str, Any], say):
     if event.get("bot_id") is not None:
         return  # avoid infinite loop
 
-    for queue in SOURCE_QUEUES.values():
-        # We dont want to await here, as the dict can change size
-        try:
-            queue.put_nowait(json.dumps(event))
-        except asyncio.queues.QueueFull:
+    log.info("Received message: %s", event)
+
+    # Serialize once, the encoded bytes are shared by every listener
+    encoded = EncodedEvent(event)
+
+    # Iterate over a copy, as the dict can change size while we await a full queue
+    for client, queue in list(SOURCE_QUEUES.items()):
+        subscription = SUBSCRIPTIONS.get(client)
+        if subscription is None or not subscription.accepts(event):
             continue
 
+        await queue.put(encoded.encode(subscription.encoding))
+
 
 def main():
     """Run the server."""
@@ -1,33 +1,140 @@
 """This module contains code for a demo document database (Qdrant vector database)."""
 
-from PyPDF2 import PdfReader
+from __future__ import annotations
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import logging
+import os
 import pathlib
+import threading
+import time
+import uuid
+from multiprocessing.managers import BaseManager
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+
+import dotenv
+from PyPDF2 import PdfReader
 from qdrant_client import QdrantClient
+from qdrant_client import models
+
+from .bm25 import BM25Index
+from .bm25 import tokenize
+from .cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+# Namespace for the content-addressed chunk ids
+_CHUNK_NAMESPACE = uuid.UUID("5b0c2a8e-8f6a-4f55-9a35-2f7cf41b1b52")
 
 
 class DocumentDatabase:
     """A vector database for document storage and querying.
 
+    Chunks are identified by a hash of the embedding model, their source and
+    their text, so uploading a chunk that is already stored doesn't embed it
+    again. `upsert_document` replaces a stored document, only embedding the
+    chunks that changed, and `delete_document` removes one. Together
+    with `path`, this lets a restarted process reuse the vectors computed by
+    the previous one and only embed the chunks that changed. Documents are
+    chunked while they are read, and embedded and stored in batches, so large
+    documents don't need to fit in memory at once.
+
+    Query embeddings and search results are cached, keyed on the normalized
+    query text. Cached results are dropped whenever documents are uploaded.
+
+    With `hybrid`, a BM25 index of the chunks is kept in memory next to the
+    vectors, and the lexical and vector search results are merged with
+    reciprocal rank fusion. This finds exact terms like API names and flags
+    that vector search can miss. Queries of at most `lexical_max_terms` terms
+    with lexical matches are answered from the BM25 index alone, saving the
+    query embedding. The index is rebuilt from the stored chunks on startup.
+
     Usage:
         # Create instance.
         db = DocumentDatabase()
 
+        # Or store the vectors on disk, to reuse them after a restart.
+        db = DocumentDatabase(path="<path_to_index_directory>")
+
         # Upload documents.
         db.upload_pdf_document("<path_to_document>")
         db.upload_txt_document("<path_to_txt_document>")
 
+        # Replace or remove a document.
+        db.upsert_document("<source>", "<text>")
+        db.delete_document("<source>")
+
         # Search database.
         search_results = db.search("Windshield wipers.")
 
         print(search_results)
     """
 
-    def __init__(self, model: str = "BAAI/bge-small-en-v1.5") -> None:
-        """Initialize database."""
-        self._client = QdrantClient(":memory:")
+    def __init__(
+        self,
+        model: str = "BAAI/bge-small-en-v1.5",
+        path: Optional[str] = None,
+        cache_size: int = 1024,
+        cache_ttl: Optional[float] = 600.0,
+        hybrid: bool = False,
+        lexical_max_terms: int = 2,
+    ) -> None:
+        """Initialize database.
+
+        Args:
+            model: Name of the embedding model.
+            path: Directory for a persistent on-disk index, in-memory if `None`.
+            cache_size: Maximum number of cached queries, 0 disables caching.
+            cache_ttl: Seconds a cached query stays valid, `None` for forever.
+            hybrid: Combine BM25 lexical search with the vector search.
+            lexical_max_terms: Longest query (in terms) that may skip the vector
+                               search in hybrid mode, 0 to never skip it.
+        """
+        if path is None:
+            self._client = QdrantClient(":memory:")
+        else:
+            self._client = QdrantClient(path=path)
 
         self._client.set_model(model)
-        self._index = 0
+        self._model = model
+        # The local client is not thread-safe, but the workers of a process, or
+        # the connections to a served database, share one instance.
+        self._lock = threading.RLock()
+        # One collection per model, as the vectors of different models don't mix.
+        # Version 2 ids include the source of the chunk.
+        vector_name = self._client.get_vector_field_name()
+        self._collection = f"document_chunks-v2-{vector_name}"
+
+        self._embedding_cache: LRUCache[list[float]] = LRUCache(cache_size, cache_ttl)
+        self._result_cache: LRUCache[list[str]] = LRUCache(cache_size, cache_ttl)
+        # Incremented whenever the documents change, see `_cache_results`
+        self._generation = 0
+
+        self._lexical_max_terms = lexical_max_terms
+        self._lexical: Optional[BM25Index] = None
+        if hybrid:
+            self._lexical = self._build_lexical_index()
+
+    def _build_lexical_index(self) -> BM25Index:
+        index = BM25Index()
+        if not self._collection_exists():
+            return index
+
+        offset = None
+        while True:
+            records, offset = self._client.scroll(
+                self._collection, limit=1024, offset=offset, with_payload=["document"]
+            )
+            for record in records:
+                index.add(str(record.id), record.payload["document"])
+            if offset is None:
+                log.info("Built lexical index of %d chunks", len(index))
+                return index
 
     def upload_pdf_document(
         self,
@@ -40,15 +147,12 @@ class DocumentDatabase:
 
         Args:
             file_path: Path to the document.
-            chunk_length: Length of an individual chunk (character count).
-            overlap: Overlap with between two chunks (character count).
+            chunk_length: Maximum length of a chunk (character count).
+            overlap: Overlap between two chunks of a paragraph (character count).
             document_name: Name of the document.
         """
-        reader = PdfReader(file_path)
-        text = ""
-        for i in range(len(reader.pages)):
-            text += reader.pages[i].extract_text()
-        self.upload_document_text(text, chunk_length, overlap, document_name)
+        chunks = _chunk_text(_pdf_pages(file_path), chunk_length, overlap)
+        self._upload_chunks(chunks, document_name)
 
     def upload_txt_document(
         self,
@@ -61,14 +165,12 @@ class DocumentDatabase:
 
         Args:
             file_path: Path to the document.
-            chunk_length: Length of an individual chunk (character count).
-            overlap: Overlap with between two chunks (character count).
+            chunk_length: Maximum length of a chunk (character count).
+            overlap: Overlap between two chunks of a paragraph (character count).
             document_name: Name of the document.
         """
-        text = ""
-        with open(file_path, "r", encoding="utf-8") as file:
-            text += file.read()
-        self.upload_document_text(text, chunk_length, overlap, document_name)
+        chunks = _chunk_text(_text_blocks(file_path), chunk_length, overlap)
+        self._upload_chunks(chunks, document_name)
 
     def upload_document_text(
         self,
@@ -81,35 +183,639 @@ class DocumentDatabase:
 
         Args:
             text: Document contents as a string.
-            chunk_length: Length of an individual chunk (character count).
-            overlap: Overlap with between two chunks (character count).
+            chunk_length: Maximum length of a chunk (character count).
+            overlap: Overlap between two chunks of a paragraph (character count).
             document_name: Name of the document.
         """
-        chunks = []
-        i = 0
-        for i in range(chunk_length - overlap, len(text), chunk_length - overlap):
-            chunks.append(text[i - (chunk_length - overlap) : i + overlap])
-        if i < len(text) - 1:
-            chunks.append(text[i:])
-
-        metadata = [{"source": source} for _ in chunks]
-        ids = [i for i in range(self._index, len(chunks) + self._index)]
-        if ids:
-            self._index = ids[-1] + 1
-        self._client.add("document_chunks", chunks, metadata, ids)
+        self._upload_chunks(_chunk_text([text], chunk_length, overlap), source)
+
+    def ingest_directory(
+        self,
+        path: str,
+        workers: Optional[int] = None,
+        pattern: str = "**/*.txt",
+        chunk_length: int = 700,
+        overlap: int = 200,
+        batch_size: int = 256,
+    ) -> dict[str, float]:
+        """Upload all text documents of a directory, using several processes.
+
+        The files are read and chunked in a pool of `workers` processes, and
+        the new chunks are embedded in batches by `workers` model instances.
+        Each file is stored with its path relative to `path` as the source, and
+        compared with the stored chunks of that source like `upsert_document`
+        does: chunks that are already stored are skipped, and stored chunks no
+        longer in the file are deleted. Sources whose file was removed from the
+        directory are not deleted.
+
+        Args:
+            path: Directory to load.
+            workers: Number of processes, all cores if `None`.
+            pattern: Glob pattern of the files to load, relative to `path`.
+            chunk_length: Maximum length of a chunk (character count).
+            overlap: Overlap between two chunks of a paragraph (character count).
+            batch_size: Number of chunks embedded and stored at a time.
+
+        Returns:
+            Item counts and seconds spent per stage (chunking, comparing with
+            the stored chunks, embedding and writing).
+        """
+        workers = workers or os.cpu_count() or 1
+        root = pathlib.Path(path)
+        files = sorted(str(file) for file in root.glob(pattern) if file.is_file())
+        stats: dict[str, float] = {
+            "files": len(files),
+            "chunks": 0,
+            "new_chunks": 0,
+            "deleted_chunks": 0,
+            "chunk_seconds": 0.0,
+            "dedup_seconds": 0.0,
+            "embed_seconds": 0.0,
+            "write_seconds": 0.0,
+        }
+
+        # Read and chunk the files in parallel
+        start = time.perf_counter()
+        jobs = [(file, chunk_length, overlap) for file in files]
+        if workers > 1 and len(files) > 1:
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                chunked = list(
+                    pool.map(_read_chunks, jobs, chunksize=max(1, len(jobs) // workers))
+                )
+        else:
+            chunked = [_read_chunks(job) for job in jobs]
+        stats["chunk_seconds"] = time.perf_counter() - start
+
+        # Keep the chunks that are already stored, and delete those of the
+        # stored versions that are not in the files anymore
+        start = time.perf_counter()
+        new_chunks: dict[str, tuple[str, str]] = {}
+        for file, chunks in zip(files, chunked):
+            source = pathlib.Path(file).relative_to(root).as_posix()
+            for chunk_id, chunk in self._chunk_ids(chunks, source):
+                new_chunks[chunk_id] = (chunk, source)
+                stats["chunks"] += 1
+        del chunked
+
+        self._ensure_collection()
+        sources = sorted({source for _, source in new_chunks.values()})
+        deleted = []
+        for i in range(0, len(sources), batch_size):
+            for chunk_id in self._stored_ids(*sources[i : i + batch_size]):
+                if new_chunks.pop(chunk_id, None) is None:
+                    deleted.append(chunk_id)
+        if deleted:
+            self._delete_points(deleted)
+        stats["new_chunks"] = len(new_chunks)
+        stats["deleted_chunks"] = len(deleted)
+        stats["dedup_seconds"] = time.perf_counter() - start
+
+        # Embed on all cores, storing each batch as soon as it is embedded
+        stats["embed_seconds"], stats["write_seconds"] = self._write_chunks(
+            new_chunks, batch_size, parallel=workers if workers > 1 else None
+        )
+
+        if new_chunks or deleted:
+            self._invalidate_results()
+
+        log.info(
+            "Ingested %s: %d files chunked in %.1f s (%.0f files/s), %d of %d chunks "
+            "new and %d deleted after %.1f s, embedded in %.1f s (%.0f chunks/s), "
+            "written in %.1f s (%.0f chunks/s)",
+            path,
+            stats["files"],
+            stats["chunk_seconds"],
+            stats["files"] / (stats["chunk_seconds"] or 1),
+            stats["new_chunks"],
+            stats["chunks"],
+            stats["deleted_chunks"],
+            stats["dedup_seconds"],
+            stats["embed_seconds"],
+            stats["new_chunks"] / (stats["embed_seconds"] or 1),
+            stats["write_seconds"],
+            stats["new_chunks"] / (stats["write_seconds"] or 1),
+        )
+        return stats
 
     def upload_text_chapterwise(self, file_path: str):
-        """Upload a text document by chunking it based on chapters."""
-        chunks = pathlib.Path(file_path).read_text().split("\n\n")
-        ids = [i for i in range(self._index, len(chunks) + self._index)]
-        if ids:
-            self._index = ids[-1] + 1
-        metadata = [{"source": "document"} for _ in chunks]
-        self._client.add("document_chunks", chunks, metadata, ids)
+        """Upload a text document by chunking it based on chapters.
+
+        Chapters are separated by blank lines, and chunked like the paragraphs
+        of `upsert_document`. The document replaces the stored version of
+        `file_path`.
+        """
+        self.upsert_document(file_path, pathlib.Path(file_path).read_text())
+
+    def upsert_document(
+        self, source: str, text: str, chunk_length: int = 700, overlap: int = 200
+    ) -> dict[str, int]:
+        """Store a document, replacing the previously stored version of `source`.
+
+        The document is split into paragraphs at blank lines, and paragraphs
+        longer than `chunk_length` into overlapping chunks. Editing a paragraph
+        thus only changes its own chunks, and only those are embedded. Chunks of
+        the stored version that are not in the new one are deleted.
+
+        Args:
+            source: Name of the document.
+            text: Document contents as a string.
+            chunk_length: Maximum length of a chunk (character count).
+            overlap: Overlap with between two chunks of a paragraph.
+
+        Returns:
+            The number of chunks kept, added and deleted.
+        """
+        chunks = dict(
+            self._chunk_ids(_chunk_text([text], chunk_length, overlap), source)
+        )
+        self._ensure_collection()
+        stored = self._stored_ids(source)
+
+        added = {
+            chunk_id: (chunk, source)
+            for chunk_id, chunk in chunks.items()
+            if chunk_id not in stored
+        }
+        deleted = [chunk_id for chunk_id in stored if chunk_id not in chunks]
+        if added:
+            self._write_chunks(added)
+        if deleted:
+            self._delete_points(deleted)
+        if added or deleted:
+            self._invalidate_results()
+
+        return {
+            "kept": len(chunks) - len(added),
+            "added": len(added),
+            "deleted": len(deleted),
+        }
+
+    def delete_document(self, source: str) -> int:
+        """Delete all chunks of a document, returning their number."""
+        if not self._collection_exists():
+            return 0
+
+        stored = list(self._stored_ids(source))
+        if stored:
+            self._delete_points(stored)
+            self._invalidate_results()
+        return len(stored)
+
+    def _chunk_ids(
+        self, chunks: Iterable[str], source: str
+    ) -> Iterator[tuple[str, str]]:
+        # Repeated chunks of a document are told apart by their occurrence
+        # number. Unlike their offset, it doesn't change when the text before
+        # them is edited, so the ids of unchanged chunks stay the same.
+        occurrences: collections.Counter[uuid.UUID] = collections.Counter()
+        for chunk in chunks:
+            chunk_id = uuid.uuid5(
+                _CHUNK_NAMESPACE, f"{self._model}\0{source}\0{chunk}"
+            )
+            occurrence = occurrences[chunk_id]
+            occurrences[chunk_id] += 1
+            if occurrence:
+                yield str(uuid.uuid5(chunk_id, str(occurrence))), chunk
+            else:
+                yield str(chunk_id), chunk
+
+    def _collection_exists(self) -> bool:
+        with self._lock:
+            collections = self._client.get_collections().collections
+        return any(c.name == self._collection for c in collections)
+
+    def _ensure_collection(self) -> None:
+        with self._lock:
+            if not self._collection_exists():
+                self._client.create_collection(
+                    self._collection,
+                    vectors_config=self._client.get_fastembed_vector_params(),
+                )
+
+    def _stored_ids(self, *sources: str) -> set[str]:
+        source_filter = models.Filter(
+            must=[
+                models.FieldCondition(key="source", match=models.MatchAny(any=sources))
+            ]
+        )
+        ids: set[str] = set()
+        offset = None
+        while True:
+            with self._lock:
+                records, offset = self._client.scroll(
+                    self._collection,
+                    scroll_filter=source_filter,
+                    limit=1024,
+                    offset=offset,
+                    with_payload=False,
+                )
+            ids.update(str(record.id) for record in records)
+            if offset is None:
+                return ids
+
+    def _delete_points(self, ids: list[str]) -> None:
+        with self._lock:
+            self._client.delete(
+                self._collection, points_selector=models.PointIdsList(points=ids)
+            )
+        if self._lexical is not None:
+            for chunk_id in ids:
+                self._lexical.remove(chunk_id)
+
+    def _upload_chunks(
+        self, chunks: Iterable[str], source: str, batch_size: int = 256
+    ) -> None:
+        # Embed and store the chunks a batch at a time, so that only one batch
+        # is held in memory no matter how long the document is.
+        uploaded = False
+        chunk_ids = self._chunk_ids(chunks, source)
+        while batch := dict(itertools.islice(chunk_ids, batch_size)):
+            uploaded |= self._upload_batch(batch, source)
+
+        # The query embeddings stay valid, but the results may have changed
+        if uploaded:
+            self._invalidate_results()
+
+    def _upload_batch(self, chunks: dict[str, str], source: str) -> bool:
+        # Only embed chunks that are not stored yet
+        self._ensure_collection()
+        with self._lock:
+            records = self._client.retrieve(
+                self._collection, list(chunks), with_payload=False
+            )
+        for record in records:
+            chunks.pop(str(record.id), None)
+
+        if not chunks:
+            return False
+
+        self._write_chunks(
+            {chunk_id: (chunk, source) for chunk_id, chunk in chunks.items()}
+        )
+        return True
+
+    def _write_chunks(
+        self,
+        chunks: dict[str, tuple[str, str]],
+        batch_size: int = 256,
+        parallel: Optional[int] = None,
+    ) -> tuple[float, float]:
+        # Embeds and stores chunks given as id -> (text, source), returning the
+        # seconds spent embedding and writing. The payload is the same as that
+        # of `QdrantClient.add`.
+        embed_seconds = write_seconds = 0.0
+        model = self._client._get_or_init_model(model_name=self._model)
+        vector_name = self._client.get_vector_field_name()
+        vectors = iter(
+            model.passage_embed(
+                [chunk for chunk, _ in chunks.values()],
+                batch_size=batch_size,
+                parallel=parallel,
+            )
+        )
+        items = iter(chunks.items())
+        while True:
+            start = time.perf_counter()
+            # The vectors go first, so that the end of a batch consumes no item
+            batch = list(zip(itertools.islice(vectors, batch_size), items))
+            embed_seconds += time.perf_counter() - start
+            if not batch:
+                return embed_seconds, write_seconds
+
+            start = time.perf_counter()
+            points = [
+                models.PointStruct(
+                    id=chunk_id,
+                    vector={vector_name: vector.tolist()},
+                    payload={"document": chunk, "source": source},
+                )
+                for vector, (chunk_id, (chunk, source)) in batch
+            ]
+            with self._lock:
+                self._client.upsert(self._collection, points)
+            if self._lexical is not None:
+                for _, (chunk_id, (chunk, _)) in batch:
+                    self._lexical.add(chunk_id, chunk)
+            write_seconds += time.perf_counter() - start
+
+    def _embed_queries(self, queries: list[str]) -> list[list[float]]:
+        # Embeds all queries in one model call. fastembed's `query_embed` only
+        # takes a single query, so apply its "query: " prefix here instead.
+        model = self._client._get_or_init_model(model_name=self._model)
+        return [
+            vector.tolist() for vector in model.embed([f"query: {q}" for q in queries])
+        ]
 
     def search(self, query: str, limit: int = 10) -> list[str]:
         """Search database."""
-        return [
-            res.document
-            for res in self._client.query("document_chunks", query, limit=limit)
+        return self.search_batch([query], limit=limit)[0]
+
+    def search_batch(self, queries: list[str], limit: int = 10) -> list[list[str]]:
+        """Search database for several queries at once.
+
+        The queries are embedded in a single model call and searched with a
+        single batched query, which is much cheaper than searching them one by
+        one. Queries found in the caches skip these steps, and so do short
+        queries answered by the lexical index in hybrid mode.
+
+        Returns:
+            The matching chunks for each query, in the order of `queries`.
+        """
+        generation = self._generation
+        normalized = [_normalize_query(query) for query in queries]
+        results: dict[str, list[str]] = {}
+        for query in normalized:
+            cached = self._result_cache.get((query, limit))
+            if cached is not None:
+                results[query] = cached
+
+        pending = list(dict.fromkeys(q for q in normalized if q not in results))
+        if self._lexical is None:
+            for query, points in zip(pending, self._vector_search(pending, limit)):
+                results[query] = [point.payload["document"] for point in points]
+                self._cache_results(generation, query, limit, results[query])
+            return [results[query] for query in normalized]
+
+        # Fuse twice as many candidates of each kind as there are results
+        candidates = 2 * limit
+        lexical = {query: self._lexical.search(query, candidates) for query in pending}
+        dense_queries = [
+            query
+            for query in pending
+            if not lexical[query] or len(tokenize(query)) > self._lexical_max_terms
         ]
+        dense = dict(zip(dense_queries, self._vector_search(dense_queries, candidates)))
+        for query in pending:
+            ranked = [[chunk_id for chunk_id, _, _ in lexical[query]]]
+            texts = {chunk_id: text for chunk_id, _, text in lexical[query]}
+            if query in dense:
+                ranked.append([str(point.id) for point in dense[query]])
+                for point in dense[query]:
+                    texts[str(point.id)] = point.payload["document"]
+
+            fused = _reciprocal_rank_fusion(ranked)[:limit]
+            results[query] = [texts[chunk_id] for chunk_id in fused]
+            self._cache_results(generation, query, limit, results[query])
+
+        return [results[query] for query in normalized]
+
+    def _invalidate_results(self) -> None:
+        # Drops the cached results, and those of searches running right now
+        with self._lock:
+            self._generation += 1
+            self._result_cache.clear()
+
+    def _cache_results(
+        self, generation: int, query: str, limit: int, results: list[str]
+    ) -> None:
+        # Results of a search that overlapped a change of the documents may
+        # predate the change, and must not outlive the clearing of the cache
+        with self._lock:
+            if generation == self._generation:
+                self._result_cache.put((query, limit), results)
+
+    def _vector_search(
+        self, queries: list[str], limit: int
+    ) -> list[list[models.ScoredPoint]]:
+        if not queries:
+            return []
+
+        vectors = self.embed_queries(queries)
+        vector_name = self._client.get_vector_field_name()
+        requests = [
+            models.SearchRequest(
+                vector=models.NamedVector(name=vector_name, vector=vector),
+                limit=limit,
+                with_payload=True,
+            )
+            for vector in vectors
+        ]
+        with self._lock:
+            return self._client.search_batch(self._collection, requests)
+
+    def embed_queries(self, queries: list[str]) -> list[list[float]]:
+        """Get the query embeddings of the given texts, using the embedding cache."""
+        queries = [_normalize_query(query) for query in queries]
+        vectors = {}
+        for query in queries:
+            cached = self._embedding_cache.get(query)
+            if cached is not None:
+                vectors[query] = cached
+
+        missing = [query for query in queries if query not in vectors]
+        if missing:
+            for query, vector in zip(missing, self._embed_queries(missing)):
+                vectors[query] = vector
+                self._embedding_cache.put(query, vector)
+
+        return [vectors[query] for query in queries]
+
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        """Hit and miss counters of the query embedding and result caches."""
+        return {
+            "embeddings": self._embedding_cache.stats(),
+            "results": self._result_cache.stats(),
+        }
+
+
+def _pdf_pages(file_path: str) -> Iterator[str]:
+    # PdfReader parses the pages on access, so only one page is extracted at a time
+    reader = PdfReader(file_path)
+    for page in reader.pages:
+        yield page.extract_text()
+
+
+def _text_blocks(file_path: str, block_size: int = 64 * 1024) -> Iterator[str]:
+    with open(file_path, "r", encoding="utf-8") as file:
+        while block := file.read(block_size):
+            yield block
+
+
+def _read_chunks(job: tuple[str, int, int]) -> list[str]:
+    # Runs in the worker processes of `DocumentDatabase.ingest_directory`
+    file_path, chunk_length, overlap = job
+    return list(_chunk_text(_text_blocks(file_path), chunk_length, overlap))
+
+
+def _chunk_text(
+    pieces: Iterable[str], chunk_length: int, overlap: int
+) -> Iterator[str]:
+    """Split the concatenation of `pieces` into chunks.
+
+    The text is split into paragraphs at blank lines, and paragraphs longer
+    than `chunk_length` into chunks of `chunk_length` characters overlapping by
+    `overlap`. Editing a paragraph thus only changes its own chunks. Chunks span
+    piece boundaries, and only the text of the current paragraph (or of its
+    current chunk, for long ones) is kept in memory, so the chunks are the same
+    however the text is split into pieces.
+
+    Raises `ValueError` unless `0 <= overlap < chunk_length`, as the chunks
+    wouldn't advance otherwise.
+    """
+    if not 0 <= overlap < chunk_length:
+        raise ValueError(
+            f"Overlap must be at least 0 and less than the chunk length "
+            f"{chunk_length}, got {overlap}"
+        )
+    return _text_chunks(pieces, chunk_length, chunk_length - overlap)
+
+
+def _text_chunks(pieces: Iterable[str], chunk_length: int, step: int) -> Iterator[str]:
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        while True:
+            end = buffer.find("\n\n")
+            if end < 0:
+                break
+            yield from _paragraph_chunks(buffer[:end], chunk_length, step)
+            buffer = buffer[end + 2 :]
+
+        # The paragraph doesn't fit in a chunk, so emit the chunks that don't
+        # reach its end yet. A trailing newline may still end the paragraph.
+        while len(buffer) > chunk_length + 1:
+            if buffer[:chunk_length].strip():
+                yield buffer[:chunk_length]
+            buffer = buffer[step:]
+
+    yield from _paragraph_chunks(buffer, chunk_length, step)
+
+
+def _paragraph_chunks(paragraph: str, chunk_length: int, step: int) -> Iterator[str]:
+    # Chunks the rest of a paragraph, of which the first chunks may already
+    # have been emitted. The last chunk is the first one reaching its end, and
+    # chunks of only whitespace are skipped.
+    while len(paragraph) > chunk_length:
+        if paragraph[:chunk_length].strip():
+            yield paragraph[:chunk_length]
+        paragraph = paragraph[step:]
+    if paragraph.strip():
+        yield paragraph
+
+
+def _reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[str]:
+    # Scores each id by the sum of 1 / (k + rank) over the rankings it is in
+    scores: dict[str, float] = collections.defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, 1):
+            scores[chunk_id] += 1 / (k + rank)
+    return sorted(scores, key=lambda chunk_id: scores[chunk_id], reverse=True)
+
+
+def _normalize_query(query: str) -> str:
+    # The embedding model is uncased, so case and spacing don't change the result
+    return " ".join(query.lower().split())
+
+
+class _DocumentDatabaseManager(BaseManager):
+    pass
+
+
+def _parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+def _check_authkey(authkey: bytes) -> None:
+    # Requests are unpickled by the server, so whoever can connect can run code
+    if not authkey:
+        raise ValueError(
+            "A non-empty authkey is required to share a document database; "
+            "set DOCUMENT_DB_AUTHKEY to a secret shared by all processes"
+        )
+
+
+def serve_document_database(
+    document_database: DocumentDatabase, address: str, authkey: bytes
+) -> None:
+    """Share a document database with other processes on the host.
+
+    Serves the database at `address` ("host:port") until interrupted. All
+    processes connecting with `connect_document_database` use this single
+    index and embedding model instead of loading their own copies.
+
+    Connections are authenticated with `authkey`, which must not be empty, as
+    the server runs whatever it is sent by an authenticated client.
+    """
+    _check_authkey(authkey)
+    _DocumentDatabaseManager.register(
+        "get_document_database", callable=lambda: document_database
+    )
+    manager = _DocumentDatabaseManager(_parse_address(address), authkey)
+    server = manager.get_server()
+    log.info("Serving document database at %s", address)
+    server.serve_forever()
+
+
+def connect_document_database(address: str, authkey: bytes) -> DocumentDatabase:
+    """Connect to a document database shared by `serve_document_database`.
+
+    The returned proxy has the same methods as `DocumentDatabase`; each call
+    is forwarded to the serving process. `authkey` must be the non-empty key
+    the database is served with.
+    """
+    _check_authkey(authkey)
+    _DocumentDatabaseManager.register("get_document_database")
+    manager = _DocumentDatabaseManager(_parse_address(address), authkey)
+    manager.connect()
+    return manager.get_document_database()  # type: ignore[attr-defined]
+
+
+def main():
+    """Load documents into a database and share it with the dataflow workers."""
+    dotenv.load_dotenv()
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("documents", nargs="*", help="Text documents to load.")
+    parser.add_argument(
+        "--directory",
+        action="append",
+        default=[],
+        help="Directory of text documents to load in parallel, can be repeated.",
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Processes used for loading directories."
+    )
+    parser.add_argument(
+        "--address",
+        default=os.environ.get("DOCUMENT_DB_ADDRESS", "127.0.0.1:7334"),
+        help="Address to serve the database at, as host:port.",
+    )
+    parser.add_argument(
+        "--path",
+        default=os.environ.get("DOCUMENT_DB_PATH") or None,
+        help="Directory of a persistent index, in-memory if not given.",
+    )
+    parser.add_argument("--model", default="BAAI/bge-small-en-v1.5")
+    parser.add_argument(
+        "--hybrid",
+        action="store_true",
+        default=bool(os.environ.get("DOCUMENT_DB_HYBRID")),
+        help="Combine lexical and vector search.",
+    )
+    args = parser.parse_args()
+
+    # Checked before loading, which can take a while
+    authkey = os.environ.get("DOCUMENT_DB_AUTHKEY", "").encode("utf-8")
+    if not authkey:
+        parser.error("DOCUMENT_DB_AUTHKEY must be set to share the database")
+
+    logging.basicConfig(level=logging.INFO)
+
+    document_database = DocumentDatabase(
+        model=args.model, path=args.path, hybrid=args.hybrid
+    )
+    for document in args.documents:
+        log.info("Loading %s...", document)
+        counts = document_database.upsert_document(
+            document, pathlib.Path(document).read_text()
+        )
+        log.info("Loaded %s: %s", document, counts)
+    for directory in args.directory:
+        document_database.ingest_directory(directory, workers=args.workers)
+
+    serve_document_database(document_database, args.address, authkey)
+
+
+if __name__ == "__main__":
+    main()